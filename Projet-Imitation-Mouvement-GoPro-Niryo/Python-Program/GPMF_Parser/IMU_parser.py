@@ -3,102 +3,298 @@ import matplotlib.pyplot as plt
 import numpy as np
 import os
 from mpl_toolkits.mplot3d import Axes3D  # Pour le tracé 3D
+from gpmf2json import load_columnar
+from alignment import align_streams, interpolate
+from orientation import apply_matrix, fourcc_text, mount_matrix, orin_matrix
+from timing import stream_times_ms
+
+# Data order in gyro and accel is Y, -X, Z and we want X, Y, Z
+AXIS_REMAP = "-y, x, z"
+
+
+class IMUSeries:
+    """Gyroscope and accelerometer samples as contiguous float64 arrays: t [N] in ms, accel [N, 3], gyro [N, 3]
+
+    Indexing and iteration give the former per-sample dicts ("3-axis gyroscope", "3-axis accelerometer",
+    "Timestamp in ms"), to_dicts the whole list as written to the 2-Reorder-IMU-Data files.
+    """
+
+    GYRO_KEY = "3-axis gyroscope"
+    ACCEL_KEY = "3-axis accelerometer"
+    TIME_KEY = "Timestamp in ms"
+
+    def __init__(self, t, accel, gyro, integral=False, orientations=None):
+        self.t = np.ascontiguousarray(t, dtype=np.float64)
+        self.accel = np.ascontiguousarray(accel, dtype=np.float64).reshape(-1, 3)
+        self.gyro = np.ascontiguousarray(gyro, dtype=np.float64).reshape(-1, 3)
+        # Échantillons bruts entiers (valeurs GPMF non mises à l'échelle), réécrits en entiers dans les dicts
+        self.integral = integral
+        # (ORIN, ORIO) des flux "accel" et "gyro" lus dans le fichier, vidé une fois les axes remappés
+        self.orientations = orientations or {}
+
+    def __len__(self):
+        return len(self.t)
+
+    def __getitem__(self, index):
+        return self.to_dicts(slice(index, index + 1) if index != -1 else slice(-1, None))[0]
+
+    def __iter__(self):
+        return iter(self.to_dicts())
+
+    def __repr__(self):
+        return "<IMUSeries {} samples>".format(len(self))
+
+    @classmethod
+    def from_dicts(cls, entries):
+        """Builds a series from a list of per-sample dicts (2-Reorder-IMU-Data file contents)"""
+        t = [entry[cls.TIME_KEY] for entry in entries]
+        gyro, gyro_integral = rows_to_array([entry[cls.GYRO_KEY] for entry in entries])
+        accel, accel_integral = rows_to_array([entry[cls.ACCEL_KEY] for entry in entries])
+        return cls(t, accel, gyro, gyro_integral and accel_integral)
+
+    def resample(self, rate_hz, window=None, method="linear"):
+        """Returns the series resampled at rate_hz over window (t0_ms, t1_ms), see alignment.align_streams"""
+        t, aligned = align_streams({"accel": (self.t, self.accel), "gyro": (self.t, self.gyro)},
+                                   rate_hz, window, method)
+        return IMUSeries(t, aligned["accel"], aligned["gyro"], self.integral and method != "linear", self.orientations)
+
+    def to_dicts(self, rows=slice(None)):
+        """Returns the samples as the former list of dicts, None for missing accelerometer samples"""
+        gyro = array_to_rows(self.gyro[rows], self.integral)
+        accel = array_to_rows(self.accel[rows], self.integral)
+        return [
+            {self.GYRO_KEY: g, self.ACCEL_KEY: a, self.TIME_KEY: t}
+            for g, a, t in zip(gyro, accel, self.t[rows].tolist())
+        ]
+
+
+def rows_to_array(rows):
+    """Converts [x, y, z] rows (None when missing) to a float64 [N, 3] array, returns it with whether all are integers"""
+    present = np.array([row for row in rows if row is not None]).reshape(-1, 3)
+    values = np.full((len(rows), 3), np.nan)
+    values[[row is not None for row in rows]] = present
+    return values, present.dtype.kind in "iu"
+
+
+def array_to_rows(values, integral):
+    """Converts a [N, 3] array back to [x, y, z] lists, None for NaN rows, integers if integral"""
+    missing = np.isnan(values).any(axis=1)
+    if integral:
+        rows = np.where(missing[:, None], 0, values).astype(np.int64).tolist()
+    else:
+        rows = values.tolist()
+    if missing.any():
+        for i in np.flatnonzero(missing).tolist():
+            rows[i] = None
+    return rows
 
 
 def get_gyro_accel_data(imu_json):
-    """Extract and flatten gyroscopic, accelerometer, and time data from the IMU data .json file"""
+    """Extract and flatten gyroscopic, accelerometer, and time data from the IMU data .json (or columnar .col) file
+
+    Returns an IMUSeries timed by the gyroscope clock fitted on its STMP/TSMP (see timing), the accelerometer
+    being interpolated at these times from its own clock. Without timestamps in the file, the samples of each
+    payload are spread over its interval as 200 samples and paired by index.
+    """
+    if os.path.splitext(imu_json)[1].lower() == ".col":
+        print(f"Reading columnar file: {os.path.basename(imu_json)}")
+        return get_columnar_series(imu_json)
     print(f"Reading JSON file: {os.path.basename(imu_json)}")
     with open(imu_json, 'r') as f:
         imu_data = json.load(f)
 
     print("Extracting gyroscope and accelerometer data...")
-    data = []
-
+    gyro_rows = []
+    accel_rows = []
+    gyro_counts = []
+    accel_counts = []
+    gyro_stmp = []
+    gyro_tsmp = []
+    accel_stmp = []
+    accel_tsmp = []
+    starts = []
+    intervals = []
+    orientations = {}
     for entry in imu_data:
-        if "Gyroscope" in entry and "3-axis gyroscope" in entry["Gyroscope"]:
-            gyro_data = entry["Gyroscope"]["3-axis gyroscope"]
-        else:
-            gyro_data = []
-
-        if "Accelerometer" in entry and "3-axis accelerometer" in entry["Accelerometer"]:
-            accel_data = entry["Accelerometer"]["3-axis accelerometer"]
-        else:
-            accel_data = []
-
+        gyro_stream = entry.get("Gyroscope", {})
+        gyro_data = gyro_stream.get("3-axis gyroscope", [])
+        gyro_stmp.append(gyro_stream.get("Timestamp in microseconds", -1))
+        gyro_tsmp.append(gyro_stream.get("Total Samples delivered", -1))
+        accel_stream = entry.get("Accelerometer", {})
+        accel_data = accel_stream.get("3-axis accelerometer", [])
+        accel_stmp.append(accel_stream.get("Timestamp in microseconds", -1))
+        accel_tsmp.append(accel_stream.get("Total Samples delivered", -1))
         if "Interval in ms" in entry:
             start_time, end_time = map(int, entry["Interval in ms"].strip("()").split(", "))
-            interval_duration = end_time - start_time
-            sample_interval = interval_duration / 199
+            starts.append(start_time)
+            intervals.append(end_time - start_time)
         else:
-            start_time = 0
-            sample_interval = 0
-
-        for i in range(len(gyro_data)):
-            timestamp = start_time + i * sample_interval
-            data_entry = {
-                "3-axis gyroscope": gyro_data[i] if i < len(gyro_data) else None,
-                "3-axis accelerometer": accel_data[i] if i < len(accel_data) else None,
-                "Timestamp in ms": timestamp
-            }
-            data.append(data_entry)
+            starts.append(0)
+            intervals.append(0)
+        gyro_rows.extend(gyro_data)
+        accel_rows.extend(accel_data)
+        gyro_counts.append(len(gyro_data))
+        accel_counts.append(len(accel_data))
+        for name, stream in (("gyro", gyro_stream), ("accel", accel_stream)):
+            if name not in orientations and "ORIN" in stream:
+                orientations[name] = (fourcc_text(stream["ORIN"]), fourcc_text(stream.get("ORIO")))
+
+    # Un seul tableau par capteur, les échantillons bruts GPMF sont des entiers
+    gyro = np.array(gyro_rows).reshape(-1, 3)
+    accel = np.array(accel_rows).reshape(-1, 3)
+    integral = gyro.dtype.kind in "iu" and accel.dtype.kind in "iu"
+    series = build_series(starts, intervals, gyro, accel, gyro_counts, accel_counts, integral,
+                          get_clock_times(gyro_stmp, gyro_tsmp, gyro_counts),
+                          get_clock_times(accel_stmp, accel_tsmp, accel_counts))
+    series.orientations = orientations
+    return series
+
+
+def get_columnar_series(imu_col):
+    """Builds the IMUSeries of a columnar .col file straight from its memory-mapped arrays"""
+    meta, arrays = load_columnar(imu_col)
+    intervals = np.asarray(arrays["intervals"], dtype=np.int64).reshape(-1, 2)
+    payloads = len(intervals)
+    samples = {}
+    for fourcc in ("GYRO", "ACCL"):
+        if fourcc in meta["streams"]:
+            samples[fourcc] = tuple(
+                np.asarray(arrays[fourcc + suffix]) for suffix in ("", "/count", "/stmp", "/tsmp")
+            )
+        else:
+            missing = np.full(payloads, -1, dtype=np.int64)
+            samples[fourcc] = (np.empty((0, 3)), np.zeros(payloads, dtype=np.int64), missing, missing)
+    gyro, gyro_counts, gyro_stmp, gyro_tsmp = samples["GYRO"]
+    accel, accel_counts, accel_stmp, accel_tsmp = samples["ACCL"]
+    gyro = gyro.reshape(-1, 3)
+    series = build_series(intervals[:, 0], intervals[:, 1] - intervals[:, 0], gyro, accel.reshape(-1, 3),
+                          gyro_counts, accel_counts, gyro.dtype.kind in "iu" and accel.dtype.kind in "iu",
+                          get_clock_times(gyro_stmp, gyro_tsmp, gyro_counts),
+                          get_clock_times(accel_stmp, accel_tsmp, accel_counts))
+    # Columnar files written before ORIN/ORIO were kept have no orientation
+    for name, fourcc in (("gyro", "GYRO"), ("accel", "ACCL")):
+        attrs = meta["streams"].get(fourcc, {})
+        if attrs.get("input_orientation"):
+            series.orientations[name] = (attrs["input_orientation"], attrs.get("output_orientation", ""))
+    return series
+
+
+def get_clock_times(stmp, tsmp, counts):
+    """Times in ms of the samples of a stream on its sensor clock, None without enough STMP to fit it"""
+    try:
+        return stream_times_ms(stmp, tsmp, counts)
+    except ValueError:
+        return None
 
-    return data
 
+def build_series(starts, intervals, gyro, accel, gyro_counts, accel_counts, integral, t=None, accel_t=None):
+    """Pairs the gyroscope samples with the accelerometer samples, interpolated at their times or of same index
 
-def reorder_data(data, base_filename):
+    t gives the gyroscope sample times, by default spread over the interval of their payload. With both t and
+    accel_t, the accelerometer is interpolated at the gyroscope times, otherwise paired by index in each payload.
+    """
+    if t is not None and accel_t is not None and len(accel_t):
+        # Horloges capteur des deux flux : l'accéléromètre est ramené aux instants du gyroscope
+        return IMUSeries(t, interpolate(t, accel_t, accel.astype(np.float64)), gyro, False)
+    gyro_counts = np.asarray(gyro_counts, dtype=np.int64)
+    accel_counts = np.asarray(accel_counts, dtype=np.int64)
+    # Rang de chaque échantillon gyroscope dans sa charge utile
+    positions = np.arange(gyro_counts.sum()) - np.repeat(np.cumsum(gyro_counts) - gyro_counts, gyro_counts)
+    if t is None:
+        sample_interval = np.asarray(intervals, dtype=np.float64) / 199
+        t = np.repeat(np.asarray(starts, dtype=np.float64), gyro_counts) + positions * np.repeat(sample_interval, gyro_counts)
+
+    # Accéléromètre apparié par rang, absent (NaN) au-delà de ses propres échantillons
+    available = positions < np.repeat(accel_counts, gyro_counts)
+    accel_index = np.repeat(np.cumsum(accel_counts) - accel_counts, gyro_counts) + positions
+    paired = np.full((len(positions), 3), np.nan)
+    paired[available] = accel[accel_index[available]]
+    return IMUSeries(t, paired, gyro, integral)
+
+
+def reorder_data(data, base_filename, mount=AXIS_REMAP, use_orientation=False, save=True):
+    """Remaps the axes of an IMUSeries (or list of per-sample dicts) in place and saves it to 2-Reorder-IMU-Data
+
+    mount is the remap to the robot frame, given as axes ("-y, x, z"), a (w, x, y, z) quaternion or a 3x3 matrix
+    (see orientation). With use_orientation, the samples are first taken to the camera frame with the ORIN/ORIO
+    of their stream, so mount is relative to the camera body rather than to the sensor channels. save=False skips
+    the 2-Reorder-IMU-Data file.
+    """
     print(f"Reordering data axes for {base_filename}")
-    output_dir = os.path.join(os.path.dirname(__file__), "2-Reorder-IMU-Data")
-    os.makedirs(output_dir, exist_ok=True)
-    output_path = os.path.join(output_dir, f"reordered_{base_filename}")
-    
+    if not isinstance(data, IMUSeries):
+        data = IMUSeries.from_dicts(data)
+
     print("Reorganizing axis orientations...")
-    # Data order in gyro and accel is Y, -X, Z and we want X, Y, Z
-    for entry in data:
-        gyro = entry["3-axis gyroscope"]
-        accel = entry["3-axis accelerometer"]
-        entry["3-axis gyroscope"] = [-gyro[1], gyro[0], gyro[2]]
-        entry["3-axis accelerometer"] = [-accel[1], accel[0], accel[2]]
-
-    print(f"Saving reordered data to: {os.path.basename(output_path)}")
-    # Write the reordered data to a JSON file
-    with open(output_path, 'w') as f:
-        json.dump(data, f, indent=4)
+    matrix = mount_matrix(mount)
+    for name, values in (("gyro", data.gyro), ("accel", data.accel)):
+        transform = matrix
+        if use_orientation:
+            if name in data.orientations:
+                transform = matrix @ orin_matrix(*data.orientations[name])
+            else:
+                print(f"Warning: no ORIN for {name}, mount applied to the sensor channels")
+        # Un seul produit matriciel sur le tableau [N, 3], en place
+        apply_matrix(values, transform)
+        # Une rotation quelconque ne garde pas les échantillons entiers
+        data.integral = data.integral and bool(np.isin(transform, (-1.0, 0.0, 1.0)).all())
+    data.orientations = {}
+
+    if save:
+        output_dir = os.path.join(os.path.dirname(__file__), "2-Reorder-IMU-Data")
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, f"reordered_{base_filename}")
+        print(f"Saving reordered data to: {os.path.basename(output_path)}")
+        # Write the reordered data to a JSON file
+        with open(output_path, 'w') as f:
+            json.dump(data.to_dicts(), f, indent=4)
 
     return data
 
 
 def get_gravity_data(imu_json):
-    """Extract and flatten gravity data from the IMU data .json file"""
-    # Utiliser un chemin absolu
-    imu_json = r'c:\Users\alexy\Dropbox\PC\Desktop\IUT Nantes\GEII\BUT_3\SAé6-GoPro_Niryo\Projet-Imitation-Mouvement-GoPro-Niryo\gopro-telemetry2json\IMU_test.json'
+    """Extract and flatten gravity data from the IMU data .json file
+
+    Returns the raw gravity vectors [N, 3] and their timestamps [N] in ms on the sensor clock of the stream (see
+    timing), spread over the interval of their payload when the file has no STMP.
+    """
     with open(imu_json, 'r') as f:
         imu_data = json.load(f)
 
-    gravity_data = []
-    gravity_timestamps = []
-
+    gravity_rows = []
+    counts = []
+    stmp = []
+    tsmp = []
+    starts = []
+    intervals = []
     for entry in imu_data:
-        if "Gravity Vector" in entry:
-            gravity_vector = entry["Gravity Vector"]["Gravity Vector"]
-            timestamp = entry["Gravity Vector"]["Timestamp in microseconds"] / 1000.0  # Convert to milliseconds
-            sample_interval = 1001 / 59  # 60 samples over 1001ms interval
-
-            for i, vector in enumerate(gravity_vector):
-                gravity_data.append(vector)
-                gravity_timestamps.append(timestamp + i * sample_interval)
-
+        gravity_stream = entry.get("Gravity Vector", {})
+        gravity_vector = gravity_stream.get("Gravity Vector", [])
+        gravity_rows.extend(gravity_vector)
+        counts.append(len(gravity_vector))
+        stmp.append(gravity_stream.get("Timestamp in microseconds", -1))
+        tsmp.append(gravity_stream.get("Total Samples delivered", -1))
+        start_time, end_time = map(int, entry.get("Interval in ms", "(0, 0)").strip("()").split(", "))
+        starts.append(start_time)
+        intervals.append(end_time - start_time)
+
+    gravity_data = np.array(gravity_rows, dtype=np.float64).reshape(-1, 3)
+    gravity_timestamps = get_clock_times(stmp, tsmp, counts)
+    if gravity_timestamps is None:
+        # Sans STMP, les échantillons sont répartis sur l'intervalle de leur charge utile
+        counts = np.asarray(counts, dtype=np.int64)
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        gravity_timestamps = np.repeat(np.asarray(starts, dtype=np.float64), counts) + positions * np.repeat(
+            np.asarray(intervals, dtype=np.float64) / np.maximum(counts, 1), counts)
     return gravity_data, gravity_timestamps
 
 
 def plot_data(data):
-    """Plot gyroscope and accelerometer data"""
-    timestamps = [entry["Timestamp in ms"] for entry in data]
-    gyro_x = [entry["3-axis gyroscope"][0] for entry in data]
-    gyro_y = [entry["3-axis gyroscope"][1] for entry in data]
-    gyro_z = [entry["3-axis gyroscope"][2] for entry in data]
-    accel_x = [entry["3-axis accelerometer"][0] for entry in data]
-    accel_y = [entry["3-axis accelerometer"][1] for entry in data]
-    accel_z = [entry["3-axis accelerometer"][2] for entry in data]
+    """Plot gyroscope and accelerometer data of an IMUSeries (or list of per-sample dicts)"""
+    if not isinstance(data, IMUSeries):
+        data = IMUSeries.from_dicts(data)
+    timestamps = data.t
+    gyro_x, gyro_y, gyro_z = data.gyro.T
+    accel_x, accel_y, accel_z = data.accel.T
 
     plt.figure(figsize=(12, 6))
 
@@ -125,14 +321,12 @@ def plot_data(data):
 
 
 def plot_data_3d(data):
-    """Plot gyroscope and accelerometer data in 3D"""
-    # Extraire les données
-    gyro_x = [entry["3-axis gyroscope"][0] for entry in data]
-    gyro_y = [entry["3-axis gyroscope"][1] for entry in data]
-    gyro_z = [entry["3-axis gyroscope"][2] for entry in data]
-    accel_x = [entry["3-axis accelerometer"][0] for entry in data]
-    accel_y = [entry["3-axis accelerometer"][1] for entry in data]
-    accel_z = [entry["3-axis accelerometer"][2] for entry in data]
+    """Plot gyroscope and accelerometer data of an IMUSeries (or list of per-sample dicts) in 3D"""
+    # Extraire les données, une colonne par axe
+    if not isinstance(data, IMUSeries):
+        data = IMUSeries.from_dicts(data)
+    gyro_x, gyro_y, gyro_z = data.gyro.T
+    accel_x, accel_y, accel_z = data.accel.T
 
     # Créer une figure avec deux sous-plots 3D
     fig = plt.figure(figsize=(15, 6))
@@ -3,6 +3,7 @@ import os
 import json
 from scipy import integrate
 from scipy.signal import butter, filtfilt
+from IMU_parser import IMUSeries
 
 class SimpleKalmanFilter:
     def __init__(self, q=0.1, r=0.1):
@@ -151,19 +152,34 @@ class WorkspaceTransformer:
         
         return transformed
 
-def convert_to_robot_format(imu_data, sampling_rate=1.0):
-    """Convert IMU data to Niryo robot format"""
+def convert_to_robot_format(imu_data, sampling_rate=1.0, orientation=None):
+    """Convert IMU data to Niryo robot format
+
+    orientation (an orientation.OrientationProvider) gives the roll, pitch, yaw of each movement in radians at
+    the time of its sample, an IMUSeries being required for the times. Without it, the gyroscope rates are used.
+    """
     processor = IMUProcessor()
     workspace_transformer = WorkspaceTransformer()
     
     # Extract acceleration and gyro data from the correct structure
     accel_data = []
     gyro_data = []
+    times = None
     
     try:
-        # Debug print pour voir la structure des données
-        print("DEBUG: Structure of first IMU data entry:", json.dumps(imu_data[0] if imu_data else {}, indent=2))
-        
+        if isinstance(imu_data, IMUSeries):
+            # Les tableaux sont rééchantillonnés sur une horloge commune à la période dt de l'intégration,
+            # sans les échantillons accéléromètre manquants, retirés des trois tableaux
+            imu_data = imu_data.resample(1.0 / processor.dt)
+            present = ~np.isnan(imu_data.accel).any(axis=1)
+            accel_data = imu_data.accel[present]
+            gyro_data = imu_data.gyro[present]
+            times = imu_data.t[present]
+            imu_data = []
+        else:
+            # Debug print pour voir la structure des données
+            print("DEBUG: Structure of first IMU data entry:", json.dumps(imu_data[0] if imu_data else {}, indent=2))
+
         for entry in imu_data:
             # Vérifier si les données sont dans la structure correcte
             if isinstance(entry, dict):
@@ -204,7 +220,7 @@ def convert_to_robot_format(imu_data, sampling_rate=1.0):
                             print(f"Warning: Could not convert gyroscope data: {e}")
                             continue
 
-        if not accel_data or not gyro_data:
+        if not len(accel_data) or not len(gyro_data):
             print("DEBUG: No data collected.")
             print(f"Accelerometer data count: {len(accel_data)}")
             print(f"Gyroscope data count: {len(gyro_data)}")
@@ -225,9 +241,16 @@ def convert_to_robot_format(imu_data, sampling_rate=1.0):
         # Calculate step size based on sampling rate
         step = int(1.0 / sampling_rate / processor.dt)
         
+        # Orientations de la caméra aux instants des positions, ou vitesses du gyroscope à défaut
+        if orientation is not None and times is not None:
+            print(f"DEBUG: Orientation from {orientation.source}")
+            orientations = orientation.at(times[::step])
+        else:
+            orientations = gyro_data[::step]
+
         # Combine positions and orientations
         combined_movements = []
-        for pos, gyro in zip(transformed_positions, gyro_data[::step]):
+        for pos, gyro in zip(transformed_positions, orientations):
             if isinstance(pos, (list, np.ndarray)) and isinstance(gyro, (list, np.ndarray)):
                 # Les positions sont déjà en mètres après la transformation
                 movement = list(pos[:3]) + list(gyro[:3])  # Combine position and orientation
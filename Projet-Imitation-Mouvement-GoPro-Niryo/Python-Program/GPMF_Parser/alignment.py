@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Resamples timestamped streams of different rates onto one common clock
+
+    t, aligned = align_streams({"ACCL": (t_accl, accl), "GYRO": (t_gyro, gyro), "CORI": (t_cori, cori)},
+                               rate_hz=200.0, quaternions={"CORI"})
+
+Vector streams are interpolated linearly (one np.interp per axis), quaternion streams by slerp, and every
+method is vectorised over the whole clock.
+"""
+import numpy as np
+
+# Streams holding orientation quaternions (w, x, y, z), interpolated by slerp
+QUATERNION_STREAMS = frozenset(("CORI", "IORI"))
+
+METHODS = ("linear", "nearest", "previous")
+
+
+def align_streams(streams, rate_hz=None, window=None, method="linear", quaternions=QUATERNION_STREAMS,
+                  reference=None):
+    """Resamples {name: (t_ms [N], values [N, k])} onto a common clock, returns (t_ms [M], {name: values [M, k]})
+
+    The clock covers window (t0_ms, t1_ms), by default the time range shared by all the streams. It runs at
+    rate_hz, or follows the timestamps of the reference stream when rate_hz is None (the fastest stream without
+    a reference). method is "linear" (slerp for the quaternions streams), "nearest" or "previous".
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown alignment method {!r}, expected one of {}".format(method, METHODS))
+    streams = {name: (np.asarray(t, dtype=np.float64), np.asarray(values, dtype=np.float64))
+               for name, (t, values) in streams.items() if len(t)}
+    if not streams:
+        return np.empty(0), {}
+    if window is None:
+        window = (max(t[0] for t, _ in streams.values()), min(t[-1] for t, _ in streams.values()))
+    if rate_hz is None:
+        if reference is None:
+            reference = max(streams, key=lambda name: len(streams[name][0]) / max(np.ptp(streams[name][0]), 1e-9))
+        clock = streams[reference][0]
+        clock = clock[(clock >= window[0]) & (clock <= window[1])]
+    else:
+        clock = window[0] + np.arange(int(np.floor((window[1] - window[0]) * rate_hz / 1000.0)) + 1) * 1000.0 / rate_hz
+    return clock, {
+        name: resample(clock, t, values, method, name in quaternions) for name, (t, values) in streams.items()
+    }
+
+
+def resample(clock, t, values, method="linear", quaternion=False):
+    """Resamples values [N, k] (or [N]) taken at t onto clock, see align_streams"""
+    if method == "linear":
+        if quaternion:
+            return slerp(clock, t, values)
+        return interpolate(clock, t, values)
+    if method == "nearest":
+        after = np.clip(np.searchsorted(t, clock), 1, len(t) - 1) if len(t) > 1 else np.zeros(len(clock), int)
+        before = np.maximum(after - 1, 0)
+        index = np.where(np.abs(clock - t[before]) <= np.abs(t[after] - clock), before, after)
+    else:
+        index = np.clip(np.searchsorted(t, clock, side='right') - 1, 0, len(t) - 1)
+    return values[index]
+
+
+def interpolate(clock, t, values):
+    """Linear interpolation of every axis of values onto clock, held at the first/last value outside of t"""
+    if values.ndim == 1:
+        return np.interp(clock, t, values)
+    aligned = np.empty((len(clock), values.shape[1]))
+    for axis in range(values.shape[1]):
+        aligned[:, axis] = np.interp(clock, t, values[:, axis])
+    return aligned
+
+
+def slerp(clock, t, quaternions):
+    """Spherical linear interpolation of (w, x, y, z) quaternions [N, 4] onto clock, normalised"""
+    quaternions = quaternions / np.linalg.norm(quaternions, axis=1, keepdims=True)
+    if len(t) < 2:
+        return np.repeat(quaternions[:1], len(clock), axis=0)
+    after = np.clip(np.searchsorted(t, clock, side='right'), 1, len(t) - 1)
+    before = after - 1
+    span = t[after] - t[before]
+    fraction = np.clip(np.divide(clock - t[before], span, out=np.zeros(len(clock)), where=span > 0), 0.0, 1.0)
+    q0 = quaternions[before]
+    q1 = quaternions[after]
+    # q and -q are the same rotation, take the shorter arc
+    dot = np.einsum('ij,ij->i', q0, q1)
+    q1 = np.where(dot[:, None] < 0, -q1, q1)
+    dot = np.abs(dot)
+    angle = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_angle = np.sin(angle)
+    # Nearly identical quaternions fall back to linear interpolation
+    close = sin_angle < 1e-6
+    safe = np.where(close, 1.0, sin_angle)
+    w0 = np.where(close, 1.0 - fraction, np.sin((1.0 - fraction) * angle) / safe)
+    w1 = np.where(close, fraction, np.sin(fraction * angle) / safe)
+    aligned = w0[:, None] * q0 + w1[:, None] * q1
+    return aligned / np.linalg.norm(aligned, axis=1, keepdims=True)
+
+
+def align_file_streams(gpmf_file, fourccs, rate_hz=None, window=None, method="linear", reference=None):
+    """Aligns streams of a GPMFFile on their sensor clocks (see timing), returns (t_ms, {fourcc: scaled values})"""
+    streams = {
+        fourcc: (gpmf_file[fourcc].sensor_timestamps, gpmf_file[fourcc].samples)
+        for fourcc in fourccs if fourcc in gpmf_file
+    }
+    return align_streams(streams, rate_hz, window, method, QUATERNION_STREAMS, reference)
+
+
+if __name__ == '__main__':
+    import sys
+    from gpmf_file import GPMFFile
+    with GPMFFile(sys.argv[1]) as gpmf:
+        rate = float(sys.argv[2]) if len(sys.argv) > 2 else None
+        t, aligned = align_file_streams(gpmf, ("ACCL", "GYRO", "GRAV", "CORI"), rate)
+        print("{} samples from {:.1f} to {:.1f} ms".format(len(t), t[0] if len(t) else 0, t[-1] if len(t) else 0))
+        for fourcc, values in aligned.items():
+            print("  {} {}".format(fourcc, values.shape))
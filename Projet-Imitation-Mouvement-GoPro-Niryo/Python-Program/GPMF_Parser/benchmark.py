@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for the GPMF parsing stages
+
+Usage: "python benchmark.py [input mp4/mov file]"
+Without a video file the benchmarks run on synthetic HERO10-like ACCL/GYRO payloads.
+"""
+import os
+import re
+import struct
+import tempfile
+import timeit
+import tracemalloc
+import construct
+import numpy as np
+from extract import MP4Reader, scan_payloads
+from gpmf2json import FOURCC_DEFINITIONS, cast_values, process_gpmf_entry
+from parse import DecodedElement, Element, PayloadDecoder, parse_value, recursive, recursive_streams
+
+# Reference copy of the former construct based KLV parser
+FOURCC = construct.Struct(
+    "key" / construct.Bytes(4),
+    "type" / construct.Byte,
+    "size" / construct.Byte,
+    "repeat" / construct.Int16ub,
+    "data" / construct.Aligned(4, construct.Bytes(construct.this.size * construct.this.repeat))
+)
+
+
+def build_imu_payload(samples=200, seed=0):
+    """Builds a DEVC payload with one ACCL and one GYRO stream of int16 triplets"""
+    rng = np.random.default_rng(seed)
+
+    def klv(key, type_char, size, repeat, data):
+        return key + struct.pack('>cBH', type_char, size, repeat) + data + b'\0' * (-len(data) % 4)
+
+    streams = b''
+    for key, name, scale in ((b'ACCL', b'Accelerometer (m/s2)', 417), (b'GYRO', b'Gyroscope (rad/s)', 939)):
+        values = rng.integers(-4096, 4096, size=(samples, 3)).astype('>i2').tobytes()
+        strm = (klv(b'STMP', b'J', 8, 1, struct.pack('>Q', 44002))
+                + klv(b'TSMP', b'L', 4, 1, struct.pack('>L', samples))
+                + klv(b'STNM', b'c', len(name), 1, name)
+                + klv(b'SCAL', b's', 2, 1, struct.pack('>h', scale))
+                + klv(key, b's', 6, samples, values))
+        streams += b'STRM' + struct.pack('>BBH', 0, 4, len(strm) // 4) + strm
+    return b'DEVC' + struct.pack('>BBH', 0, 4, len(streams) // 4) + streams
+
+
+def build_gps9_element(samples=100, seed=0):
+    """Builds a complex GPS9 element of samples records, TYPE lllllllSS"""
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype([('f{}'.format(i), '>i4') for i in range(7)] + [('f7', '>u2'), ('f8', '>u2')])
+    records = np.zeros(samples, dtype=dtype)
+    for name in dtype.names:
+        records[name] = rng.integers(0, 1 << 15, size=samples)
+    return Element(b'GPS9', ord('?'), dtype.itemsize, samples, memoryview(records.tobytes()), b'lllllllSS')
+
+
+def get_imu_elements(payloads):
+    """Collects the ACCL and GYRO elements of the given payloads"""
+    return [
+        element
+        for gpmf_data in payloads
+        for element, _ in recursive(gpmf_data)
+        if element.key in (b'ACCL', b'GYRO')
+    ]
+
+
+def parse_value_struct(element):
+    """Reference copy of the former struct.unpack based tuple path, for int16 elements"""
+    struct_repeat = element.repeat
+    if element.size > 2:
+        struct_repeat = int(element.repeat * (element.size / 2))
+    value_parsed = struct.unpack(">{}".format(''.join(['h' for x in range(struct_repeat)])), element.data)
+    if len(value_parsed) == 1:
+        return value_parsed[0]
+    if len(value_parsed) > element.repeat:
+        n = int(len(value_parsed) / element.repeat)
+        return [value_parsed[i:i + n] for i in range(0, len(value_parsed), n)]
+    return list(value_parsed)
+
+
+def decode_payload_legacy(gpmf_data):
+    """Reference copy of the former per-element decode of gpmf2json, dispatching on every element"""
+    data_entry = []
+    for element, parents in recursive(gpmf_data):
+        try:
+            value = parse_value(element)
+        except ValueError:
+            value = bytes(element.data)
+        data_entry.append(([x.decode("latin-1") for x in list(parents) + [element.key]], value))
+    return data_entry
+
+
+def process_gpmf_entry_legacy(key, val):
+    """Reference copy of the former STMP-split grouping of process_gpmf_entry"""
+    data_a = [i for i, j in enumerate(val) if "STMP" in j[0]]
+    data_b = [0] + data_a + [len(val)]
+    data_c = list(zip(data_b[:-1], data_b[1:]))
+    data_d = list(map(lambda x: val[x[0] : x[1]], data_c))
+    return (
+        {"Interval in ms": key}
+        | {
+            FOURCC_DEFINITIONS.get(x[0][-1], x[0][-1]): cast_values(x[0], x[1])
+            for x in data_d[0]
+        }
+        | {
+            re.sub(r"[\(\[].*?[\)\]]", "", x[2][1].decode("latin-1")).strip(): {
+                FOURCC_DEFINITIONS.get(y[0][-1], y[0][-1]): cast_values(y[0], y[1])
+                for y in x[:2] + x[3:]
+            }
+            for x in data_d[1:]
+        }
+    )
+
+
+def recursive_construct(data, parents=tuple()):
+    """Reference copy of the former construct based recursive parser"""
+    for element in FOURCC[:].parse(data):
+        if element.type == 0:
+            for subyield in recursive_construct(element.data, parents + (element.key,)):
+                yield subyield
+        else:
+            yield (element, parents)
+
+
+def peak_memory(func):
+    """Returns the peak traced allocation size of func in bytes"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def retained_memory(func):
+    """Returns the traced size in bytes of the objects allocated by func and still referenced by its result"""
+    tracemalloc.start()
+    try:
+        result = func()
+        retained = tracemalloc.get_traced_memory()[0]
+        del result
+        return retained
+    finally:
+        tracemalloc.stop()
+
+
+def bench(label, func, number):
+    """Runs func number times and prints the time per pass"""
+    elapsed = min(timeit.repeat(func, number=number, repeat=3))
+    print("{:<40} {:>10.2f} ms/pass".format(label, elapsed / number * 1e3))
+    return elapsed
+
+
+def bench_parse_value(elements, number=20):
+    """Compares the struct tuple path with the NumPy decoder on ACCL/GYRO elements"""
+    print("parse_value on {} ACCL/GYRO elements".format(len(elements)))
+    base = bench("struct.unpack tuples", lambda: [parse_value_struct(e) for e in elements], number)
+    tuples = bench("parse_value", lambda: [parse_value(e) for e in elements], number)
+    arrays = bench("parse_value(as_array=True)", lambda: [parse_value(e, as_array=True) for e in elements], number)
+    print("speedup: {:.1f}x (tuples), {:.1f}x (arrays)".format(base / tuples, base / arrays))
+
+
+def bench_complex(element, number=200):
+    """Compares a per-record struct.unpack loop with the structured dtype decoder on a complex element"""
+    print("complex {} element of {} records".format(element.key.decode('latin-1'), element.repeat))
+    record = struct.Struct('>lllllllHH')
+    per_record = lambda: [record.unpack_from(element.data, i * record.size) for i in range(element.repeat)]
+    base = bench("struct.unpack per record", per_record, number)
+    records = bench("parse_value(as_array=True)", lambda: parse_value(element, as_array=True), number)
+    print("speedup: {:.1f}x".format(base / records))
+
+
+def bench_decoder(payloads, number=5):
+    """Compares the per-element dispatch with the compiled plan of PayloadDecoder over whole payloads"""
+    print("payload decode on {} payloads".format(len(payloads)))
+    decoder = PayloadDecoder()
+    base = bench("recursive + parse_value", lambda: [decode_payload_legacy(p) for p in payloads], number)
+    planned = bench("PayloadDecoder plan", lambda: [decoder.decode(p) for p in payloads], number)
+    print("speedup: {:.1f}x, {} plan(s) compiled".format(base / planned, decoder.compiled))
+    # Locating the elements alone, the plan reading headers at the offsets it reaches
+    walk = bench("recursive_streams walk", lambda: [list(recursive_streams(p)) for p in payloads], number)
+    follow = bench("PayloadDecoder.follow_plan", lambda: [decoder.follow_plan(p) for p in payloads], number)
+    print("speedup: {:.1f}x".format(walk / follow))
+
+
+def bench_grouping(payloads, number=20):
+    """Compares the STMP-split grouping with the single pass STRM grouping of process_gpmf_entry"""
+    decoder = PayloadDecoder()
+    # Values are decoded before timing, so that only the grouping is measured
+    decoded = [(str((i, i + 1)), [DecodedElement(e.path, e.value, e.strm) for e in decoder.elements(p)])
+               for i, p in enumerate(payloads)]
+    tuples = [(key, [tuple(e) for e in elements]) for key, elements in decoded]
+    print("stream grouping on {} payloads".format(len(decoded)))
+    base = bench("STMP split + regex + dict merge", lambda: [process_gpmf_entry_legacy(k, v) for k, v in tuples],
+                 number)
+    single = bench("single pass on STRM numbers", lambda: [process_gpmf_entry(k, v) for k, v in decoded], number)
+    print("speedup: {:.1f}x, {:.1f} us/payload".format(base / single, single / number / len(decoded) * 1e6))
+
+
+def bench_recursive(payloads, number=5):
+    """Compares the construct parser with the memoryview KLV walker over whole payloads"""
+    print("recursive on {} payloads".format(len(payloads)))
+    walk_construct = lambda: [list(recursive_construct(p)) for p in payloads]
+    walk_view = lambda: [list(recursive(p)) for p in payloads]
+    base = bench("construct FOURCC[:]", walk_construct, number)
+    walker = bench("walk_klv memoryview", walk_view, number)
+    print("speedup: {:.1f}x".format(base / walker))
+    print("peak memory: {:.0f} KiB (construct), {:.0f} KiB (walk_klv)".format(
+        peak_memory(walk_construct) / 1024, peak_memory(walk_view) / 1024))
+
+
+def bench_memory(payloads):
+    """Compares the memory held by decoded payloads: per-element key lists and values vs GPMFElement records
+
+    The limit on the records is checked by test_parse.test_elements_memory.
+    """
+    print("decoded payloads held in memory, {} payloads".format(len(payloads)))
+    decoder = PayloadDecoder()
+    legacy = retained_memory(lambda: [decode_payload_legacy(p) for p in payloads])
+    records = retained_memory(lambda: [decoder.elements(p) for p in payloads])
+    print("{:<40} {:>10.0f} KiB".format("key lists + decoded values", legacy / 1024))
+    print("{:<40} {:>10.0f} KiB".format("GPMFElement records", records / 1024))
+    print("reduction: {:.1f}x".format(legacy / records))
+
+
+def bench_scan(payloads, frame_bytes=256 * 1024, number=3):
+    """Measures the DEVC scan of a moov-less file, payloads interleaved with random frame data"""
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, frame_bytes, dtype=np.uint8).tobytes()
+    with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as fp:
+        for gpmf_data in payloads * 10:
+            fp.write(frame)
+            fp.write(gpmf_data)
+    try:
+        with MP4Reader(fp.name) as reader:
+            print("moov-less scan of {:.0f} MiB".format(reader.size / 1024 ** 2))
+            elapsed = bench("scan_payloads", lambda: scan_payloads(reader, 0, reader.size), number)
+            found = len(scan_payloads(reader, 0, reader.size)[0])
+            print("{:.0f} MiB/s, {} of {} payloads found".format(
+                reader.size / 1024 ** 2 / (elapsed / number), found, len(payloads) * 10))
+    finally:
+        os.remove(fp.name)
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        from extract import get_gpmf_payloads_from_file
+        payloads, _ = get_gpmf_payloads_from_file(sys.argv[1])
+        payloads = [gpmf_data for gpmf_data, _ in payloads]
+    else:
+        payloads = [build_imu_payload(seed=i) for i in range(50)]
+    bench_parse_value(get_imu_elements(payloads))
+    bench_complex(build_gps9_element())
+    bench_recursive(payloads)
+    bench_decoder(payloads)
+    bench_grouping(payloads)
+    bench_memory(payloads)
+    bench_scan(payloads)
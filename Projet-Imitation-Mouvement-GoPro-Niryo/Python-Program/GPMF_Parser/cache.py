@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Content-addressed cache of the processing stage results"""
+import hashlib
+import json
+import os
+import shutil
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+# Cache size above which the least recently used results are evicted
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Bytes hashed at each end of a video to fingerprint it
+FINGERPRINT_BLOCK = 1024 ** 2
+
+# Version of the stage outputs, part of every key: bump it in the change that alters what a stage writes
+CACHE_VERSION = 2
+
+
+def file_fingerprint(filepath, block=FINGERPRINT_BLOCK):
+    """Fingerprints a video by its size and its first and last blocks (mdat start and, for GoPro files, moov)"""
+    size = os.path.getsize(filepath)
+    digest = hashlib.blake2b(str(size).encode("ascii"), digest_size=16)
+    with open(filepath, "rb") as fp:
+        digest.update(fp.read(block))
+        if size > block:
+            fp.seek(max(block, size - block))
+            digest.update(fp.read(block))
+    return digest.hexdigest()
+
+
+def make_key(*parts):
+    """Builds a cache key from CACHE_VERSION and JSON-serializable parts (fingerprints, previous keys, parameters)"""
+    return hashlib.blake2b(json.dumps([CACHE_VERSION, parts], sort_keys=True).encode("utf-8"),
+                           digest_size=16).hexdigest()
+
+
+class StageCache:
+    """Directory of stage result files named by their key, evicted least recently used first
+
+    enabled=False never reads nor writes, refresh=True ignores existing results but stores the new ones.
+    auto_evict=False leaves eviction to an explicit evict() call, for caches shared by worker processes.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, enabled=True, refresh=False,
+                 auto_evict=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.refresh = refresh
+        self.auto_evict = auto_evict
+
+    def for_workers(self):
+        """Returns the same cache without eviction on put, the parent process evicting once the workers are done"""
+        return StageCache(self.cache_dir, self.max_bytes, self.enabled, self.refresh, auto_evict=False)
+
+    def path(self, key, suffix):
+        """Returns the path of the result stored under key"""
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def get(self, key, suffix, destination):
+        """Copies the result stored under key to destination, returns False on a miss"""
+        if not self.enabled or self.refresh:
+            return False
+        path = self.path(key, suffix)
+        try:
+            shutil.copyfile(path, destination)
+        except FileNotFoundError:
+            return False
+        # mtime records the last use for the LRU eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted since the copy, which is still valid
+            pass
+        return True
+
+    def put(self, key, suffix, source):
+        """Stores a copy of the source result file under key, then evicts old results"""
+        if not self.enabled:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key, suffix)
+        # One temporary file per process, workers may store the same key at once
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, path)
+        if self.auto_evict:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used results until the cache fits in max_bytes
+
+        Files being written (*.tmp) are left alone, files removed meanwhile by another process are skipped.
+        """
+        try:
+            names = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            return
+        entries = []
+        for name in names:
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Removes every cached result"""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Groups GoPro chapter files (GH01xxxx.MP4, GH02xxxx.MP4, ...) into sessions with continuous timestamps
+
+GoPro splits long recordings into chapters named <prefix><chapter><file number>.MP4, the file number being
+shared by every chapter of a recording: GH/GX (HERO6 and later) use chapters 01, 02, ..., older cameras name
+the first chapter GOPRxxxx and the next ones GP01xxxx, GP02xxxx, ...
+"""
+import os
+import re
+from gpmf_index import get_payload_locations, open_index
+
+CHAPTER_PATTERN = re.compile(r"^(G[HX])(\d{2})(\d{4})\.(mp4|mov)$", re.IGNORECASE)
+LEGACY_CHAPTER_PATTERN = re.compile(r"^(GOPR|GP(\d{2}))(\d{4})\.(mp4|mov)$", re.IGNORECASE)
+
+
+def chapter_of(filename):
+    """Returns the (session key, chapter number) of a GoPro chapter file name, None for other names"""
+    match = CHAPTER_PATTERN.match(filename)
+    if match:
+        return ((match.group(1).upper(), match.group(3)), int(match.group(2)))
+    match = LEGACY_CHAPTER_PATTERN.match(filename)
+    if match:
+        return (("GP", match.group(3)), int(match.group(2) or 0))
+    return None
+
+
+def group_chapters(filenames):
+    """Groups file names into sessions, returns [[chapter file names in chapter order]]
+
+    Sessions are ordered by their first file in filenames, files that are not GoPro chapters are sessions of
+    their own.
+    """
+    sessions = {}
+    for filename in filenames:
+        chapter = chapter_of(os.path.basename(filename))
+        key = chapter[0] if chapter else filename
+        sessions.setdefault(key, []).append((chapter[1] if chapter else 0, filename))
+    return [[filename for _, filename in sorted(chapters)] for chapters in sessions.values()]
+
+
+def chapter_paths(infile):
+    """Returns the chapter files of a video input, a single path or a sequence of chapter paths"""
+    if isinstance(infile, (list, tuple)):
+        return list(infile)
+    return [infile]
+
+
+def first_stmp(index, fourcc=None):
+    """Returns (fourcc, STMP in µs) of the first payload of fourcc, or of the first stream having one"""
+    for name, stream in index.streams.items():
+        if fourcc not in (None, name) or not len(stream.stmp) or stream.stmp[0] < 0:
+            continue
+        return (name, int(stream.stmp[0]))
+    return (fourcc, None)
+
+
+def iter_chapter_locations(infile):
+    """Yields (chapter path, index, [(offset, size, (start ms, end ms))]) with times continuing across chapters
+
+    A chapter starts at its STMP distance to the first chapter when both carry STMP timestamps, otherwise (or if
+    STMP went backwards) right after the end of the previous chapter. Chapters are indexed one at a time, as the
+    iteration reaches them.
+    """
+    origin = None
+    fourcc = None
+    previous_end = 0
+    for number, chapter in enumerate(chapter_paths(infile)):
+        index = open_index(chapter)
+        locations = get_payload_locations(chapter, index)
+        fourcc, stmp = first_stmp(index, fourcc)
+        if number == 0:
+            origin = stmp
+            offset = 0
+        elif origin is not None and stmp is not None and (stmp - origin) // 1000 >= previous_end:
+            offset = (stmp - origin) // 1000
+        else:
+            offset = previous_end
+        if offset:
+            locations = [(position, size, (start + offset, end + offset)) for position, size, (start, end) in locations]
+        if locations:
+            previous_end = locations[-1][2][1]
+        yield (chapter, index, locations)
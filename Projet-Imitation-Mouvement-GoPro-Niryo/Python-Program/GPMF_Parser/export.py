@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Exports the GPMF track of MP4/MOV files to compact telemetry-only MP4 files
+
+The exported file keeps the ftyp, mvhd and the gpmd trak of the source (tkhd, mdhd, hdlr, media header, dinf,
+stsd and sample timing) and stores the payloads back to back in a single chunk of its mdat. It is a regular
+MP4 with one GPMF track, so every stage reading videos (gpmf2json, gpmf_index, main...) accepts it as is.
+Files without moov get a new trak around the payloads recovered from their mdat (see extract.recover_sample_table).
+"""
+import os
+import struct
+import numpy as np
+from extract import MP4Reader, build_sample_table, find_gpmd_minf_atom, find_gpmd_stbl_atom, get_payloads
+
+# Tables rewritten for the single chunk layout, the other stbl children are copied
+REWRITTEN_TABLES = (b'stts', b'stsc', b'stsz', b'stco', b'co64')
+
+
+def export_telemetry(infile, outfile):
+    """Writes the telemetry-only MP4 of infile to outfile, returns outfile"""
+    reader = MP4Reader(infile)
+    tmp_path = outfile + ".tmp"
+    try:
+        # Located once, a file without moov is scanned for its payloads here
+        stbl = find_gpmd_stbl_atom(reader)
+        if stbl is None:
+            raise ValueError("No GPMF track found in {}".format(infile))
+        payloads = get_payloads(stbl)
+        table = build_sample_table(stbl)
+        ftyp = reader.find(b'ftyp')
+        ftyp = box(b'ftyp', reader.read(ftyp[0], ftyp[1] - ftyp[0])) if ftyp else box(b'ftyp', b'mp41\0\0\0\0mp41isom')
+        data_size = int(table['size'].sum())
+        # Payloads follow the ftyp and the mdat header, a 64-bit largesize header beyond 4 GiB
+        mdat_header = struct.pack('>I4s', 8 + data_size, b'mdat') if 8 + data_size < 1 << 32 else \
+            struct.pack('>I4sQ', 1, b'mdat', 16 + data_size)
+        moov = build_moov(reader, stbl.timescale, table, len(ftyp) + len(mdat_header))
+        with open(tmp_path, 'wb') as fp:
+            fp.write(ftyp)
+            fp.write(mdat_header)
+            for gpmf_data, _ in payloads:
+                fp.write(gpmf_data)
+            fp.write(moov)
+    finally:
+        reader.close()
+    os.replace(tmp_path, outfile)
+    return outfile
+
+
+def build_moov(reader, timescale, table, chunk_offset):
+    """Builds a moov holding the mvhd and the gpmd trak of reader, its samples being one chunk at chunk_offset"""
+    # Sample timing and sizes, run-length encoded like the source stts
+    durations = table['end'] - table['start']
+    run_starts = np.flatnonzero(np.diff(durations, prepend=-1)) if len(durations) else np.empty(0, np.int64)
+    run_counts = np.diff(np.append(run_starts, len(durations)))
+    stts = np.column_stack((run_counts, durations[run_starts])).astype('>u4')
+    tables = [
+        full_box(b'stts', struct.pack('>I', len(stts)) + stts.tobytes()),
+        full_box(b'stsc', struct.pack('>IIII', 1, 1, len(table), 1)),
+        full_box(b'stsz', struct.pack('>II', 0, len(table)) + table['size'].astype('>u4').tobytes()),
+        full_box(b'stco', struct.pack('>II', 1, chunk_offset)) if chunk_offset < 1 << 32 else
+        full_box(b'co64', struct.pack('>IQ', 1, chunk_offset)),
+    ]
+    minf_atom = find_gpmd_minf_atom(reader)
+    if minf_atom is None:
+        # Payloads recovered from a file without moov, there are no track headers to copy
+        return build_track_moov(timescale, int(durations.sum()), tables)
+
+    moov = reader.find(b'moov')
+    mdia, minf = minf_atom
+    trak = next(
+        (payload, box_end) for box_type, payload, box_end in reader.boxes(*moov)
+        if box_type == b'trak' and payload <= mdia[0] < box_end
+    )
+    stbl = reader.find(b'stbl', *minf)
+    new_stbl = box(b'stbl', b''.join(
+        [raw for box_type, raw in child_boxes(reader, *stbl) if box_type not in REWRITTEN_TABLES] + tables
+    ))
+    new_minf = box(b'minf', b''.join(
+        new_stbl if box_type == b'stbl' else raw for box_type, raw in child_boxes(reader, *minf)
+    ))
+    new_mdia = box(b'mdia', b''.join(
+        new_minf if box_type == b'minf' else raw for box_type, raw in child_boxes(reader, *mdia)
+    ))
+    # tref and edts refer to the dropped video track
+    new_trak = box(b'trak', b''.join(
+        new_mdia if box_type == b'mdia' else raw
+        for box_type, raw in child_boxes(reader, *trak) if box_type in (b'tkhd', b'mdia')
+    ))
+    mvhd = [raw for box_type, raw in child_boxes(reader, *moov) if box_type == b'mvhd']
+    return box(b'moov', b''.join(mvhd) + new_trak)
+
+
+def build_track_moov(timescale, duration, tables):
+    """Builds a moov with a single gpmd trak from scratch, tables being its stts/stsc/stsz/stco boxes"""
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    duration = min(duration, 0xFFFFFFFF)
+    mvhd = full_box(b'mvhd', struct.pack('>IIIIIH10x', 0, 0, timescale, duration, 0x10000, 0x100) + matrix +
+                    bytes(24) + struct.pack('>I', 2))
+    # Flags: track enabled and in movie
+    tkhd = full_box(b'tkhd', struct.pack('>IIIII8xHHH2x', 0, 0, 1, 0, duration, 0, 0, 0) + matrix + bytes(8),
+                    flags=3)
+    # Language 'und'
+    mdhd = full_box(b'mdhd', struct.pack('>IIIIHH', 0, 0, timescale, duration, 0x55C4, 0))
+    hdlr = full_box(b'hdlr', struct.pack('>I4s12x', 0, b'meta') + b'GoPro MET\0')
+    dinf = box(b'dinf', full_box(b'dref', struct.pack('>I', 1) + full_box(b'url ', b'', flags=1)))
+    stsd = full_box(b'stsd', struct.pack('>I', 1) + box(b'gpmd', struct.pack('>6xH', 1)))
+    minf = box(b'minf', full_box(b'nmhd', b'') + dinf + box(b'stbl', stsd + b''.join(tables)))
+    return box(b'moov', mvhd + box(b'trak', tkhd + box(b'mdia', mdhd + hdlr + minf)))
+
+
+def child_boxes(reader, start, end):
+    """Yields (type, raw box bytes) of the boxes between start and end"""
+    pos = start
+    for box_type, _, box_end in reader.boxes(start, end):
+        yield (box_type, reader.read(pos, box_end - pos))
+        pos = box_end
+
+
+def box(box_type, payload):
+    """Builds a box from its type and payload"""
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type, payload, version=0, flags=0):
+    """Builds a full box, version and flags preceding the payload"""
+    return box(box_type, struct.pack('>I', (version << 24) | flags) + payload)
+
+
+def export_directory(input_dir, output_dir):
+    """Exports every MP4/MOV file of input_dir to output_dir under the same name, chapters stay groupable"""
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+    for filename in sorted(os.listdir(input_dir)):
+        if os.path.splitext(filename)[1].lower() not in (".mp4", ".mov"):
+            continue
+        try:
+            results.append(export_telemetry(os.path.join(input_dir, filename), os.path.join(output_dir, filename)))
+        except Exception as e:
+            print("ERROR: {}: {}".format(filename, e))
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 3:
+        print('Use the format "python export.py [input mp4/mov file or directory] [output directory]"')
+        sys.exit(1)
+    input_path, output_dir = os.path.abspath(sys.argv[1]), os.path.abspath(sys.argv[2])
+    if os.path.isdir(input_path):
+        exported = export_directory(input_path, output_dir)
+    else:
+        os.makedirs(output_dir, exist_ok=True)
+        exported = [export_telemetry(input_path, os.path.join(output_dir, os.path.basename(input_path)))]
+    for path in exported:
+        print("{} ({} bytes)".format(path, os.path.getsize(path)))
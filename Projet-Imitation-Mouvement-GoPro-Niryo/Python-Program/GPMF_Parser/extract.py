@@ -1,136 +1,403 @@
 #!/usr/bin/env python3
-import hachoir.parser
-from hachoir.field import MissingField
-from hachoir.field.string_field import String
+"""Reads the GPMF track of MP4/MOV files with a memory-mapped ISO-BMFF box reader"""
+import mmap
+import os
+import re
+import struct
+import numpy as np
 
+BOX_HEADER = struct.Struct('>I4s')
+KLV_HEADER = struct.Struct('>4sBBH')
 
-def get_raw_content(met):
-    """Reads the raw bytes from the stream for this atom/field"""
-    if hasattr(met, 'stream'):
-        stream = met.stream
-    else:
-        stream = met.parent.stream
-    return stream.read(met.absolute_address, met.size)
+# GPMF value types, 0 being a nested container
+KLV_TYPES = frozenset(b'bBcdfFGhHjJlLqQsSU?')
+FOURCC_PATTERN = re.compile(rb'[A-Z0-9 ]{4}')
+
+# Payload times recovered from STMP are in microseconds, payloads without any are assumed to last 1 s
+RECOVERY_TIMESCALE = 1000000
+
+# Per-sample table built from stbl, times in track timescale ticks
+SAMPLE_TABLE_DTYPE = np.dtype([
+    ('offset', np.int64),
+    ('size', np.int64),
+    ('start', np.int64),
+    ('end', np.int64),
+])
+
+# Boxes whose payload is a plain list of child boxes
+CONTAINER_BOXES = (b'moov', b'trak', b'mdia', b'minf', b'stbl', b'dinf', b'edts', b'udta', b'gmhd')
+
+
+class MP4Reader:
+    """Memory-mapped MP4 file, walks boxes by their headers without reading payloads"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = open(filepath, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b''
+
+    def close(self):
+        """Unmaps and closes the file"""
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def boxes(self, start=0, end=None):
+        """Iterates the boxes between start and end, yielding (type, payload offset, box end)"""
+        if end is None:
+            end = self.size
+        pos = start
+        while pos + 8 <= end:
+            size, box_type = BOX_HEADER.unpack_from(self.data, pos)
+            header = 8
+            if size == 1:
+                # 64-bit largesize follows the type
+                size = struct.unpack_from('>Q', self.data, pos + 8)[0]
+                header = 16
+            elif size == 0:
+                # Box extends to the end of its parent
+                size = end - pos
+            if size < header or pos + size > end:
+                # Truncated or corrupt box
+                return
+            yield (box_type, pos + header, pos + size)
+            pos += size
+
+    def find(self, box_type, start=0, end=None):
+        """Returns (payload offset, box end) of the first box_type child, or None"""
+        for child_type, payload, box_end in self.boxes(start, end):
+            if child_type == box_type:
+                return (payload, box_end)
+        return None
+
+    def find_path(self, path, start=0, end=None):
+        """Follows a 'moov/trak/...' path of first matches, returns (payload offset, box end) or None"""
+        box = (start, end)
+        for box_type in path.split('/'):
+            box = self.find(box_type.encode('latin-1'), *box)
+            if box is None:
+                return None
+        return box
+
+    def read(self, offset, size):
+        """Reads size bytes at offset"""
+        return self.data[offset:offset + size]
+
+    def read_table(self, offset, count, columns=1, dtype='>u4'):
+        """Decodes a big-endian integer table in one call into a native int64 array"""
+        table = np.frombuffer(self.data, dtype=dtype, count=count * columns, offset=offset)
+        table = table.astype(np.int64)
+        return table.reshape(count, columns) if columns > 1 else table
+
+
+class SampleTable:
+    """Decoded stbl tables of a track, read from reader"""
+
+    def __init__(self, reader, timescale, stts, stsc, stsz, chunk_offsets):
+        self.reader = reader
+        self.timescale = timescale
+        # (sample_count, sample_delta) runs
+        self.stts = stts
+        # (first_chunk, samples_per_chunk, sample_description_index) runs
+        self.stsc = stsc
+        # Size of every sample
+        self.stsz = stsz
+        # Offset of every chunk, from stco or co64
+        self.chunk_offsets = chunk_offsets
 
 
 def get_gpmf_payloads_from_file(filepath):
-    """Get payloads from file, returns a tuple with the payloads iterator and the parser instance"""
-    parser = hachoir.parser.createParser(filepath)
-    return (get_payloads(find_gpmd_stbl_atom(parser)), parser)
+    """Get payloads from file, returns a tuple with the payloads iterator and the reader instance"""
+    reader = MP4Reader(filepath)
+    return (get_payloads(find_gpmd_stbl_atom(reader)), reader)
 
 
-def get_gpmf_payloads(parser):
+def get_gpmf_payloads(reader):
     """Shorthand for finding the GPMF atom to be passed to get_payloads"""
-    return get_payloads(find_gpmd_stbl_atom(parser))
+    return get_payloads(find_gpmd_stbl_atom(reader))
 
 
 def get_payloads(stbl):
-    """Get payloads by chunk from stbl, with timing info"""
-    # Locate needed subatoms
-    for subatom in stbl:
-        tag = subatom['tag']
-        if tag.value == 'stsz':
-            stsz = subatom['stsz']
-        if tag.value == 'stco':
-            stco = subatom['stco']
-        if tag.value == 'stts':
-            stts = subatom['stts']
-
-    # Generate start and end timestamps for all chunks
-    timestamps = []
-    for idx in range(stts['count'].value):
-        sample_delta = stts["sample_delta[{}]".format(idx)].value
-        for idx2 in range(stts["sample_count[{}]".format(idx)].value):
-            if idx == 0 and idx2 == 0:
-                sampletimes = (0, sample_delta)
-            else:
-                sampletimes = (timestamps[-1][1], timestamps[-1][1] + sample_delta)
-            timestamps.append(sampletimes)
-
-    # Read chunks, yield with timing data
-    num_samples = stsz['count'].value
-    for idx in range(num_samples):
-        offset = stco["chunk_offset[{}]".format(idx)].value
-        size = stsz["sample_size[{}]".format(idx)].value
-        data = stbl.stream.read(offset * 8, size * 8)[1]
-        yield (data, timestamps[idx])
+    """Get payloads by sample from stbl, with timing info in ms"""
+    if stbl is None:
+        raise ValueError("No GPMF track found")
+    table = build_sample_table(stbl)
+    starts = ticks_to_ms(table['start'], stbl.timescale).tolist()
+    ends = ticks_to_ms(table['end'], stbl.timescale).tolist()
+
+    # Read samples, yield with timing data
+    for offset, size, start, end in zip(table['offset'].tolist(), table['size'].tolist(), starts, ends):
+        yield (stbl.reader.read(offset, size), (start, end))
+
+
+def build_sample_table(stbl):
+    """Expands the stts/stsc/stsz/stco/co64 runs of stbl into a SAMPLE_TABLE_DTYPE array"""
+    sizes = stbl.stsz
+    chunk_offsets = stbl.chunk_offsets
+
+    # Chunk of every sample from the (first_chunk, samples_per_chunk) runs of stsc
+    first_chunks = np.minimum(stbl.stsc[:, 0] - 1, len(chunk_offsets))
+    run_lengths = np.maximum(np.diff(np.append(first_chunks, len(chunk_offsets))), 0)
+    chunk_samples = np.repeat(stbl.stsc[:, 1], run_lengths)
+    sample_chunks = np.repeat(np.arange(len(chunk_offsets)), chunk_samples)
+    count = min(len(sizes), len(sample_chunks))
+    sizes = sizes[:count]
+    sample_chunks = sample_chunks[:count]
+
+    # Samples of a chunk are contiguous, offset by the sizes of the samples before them in it
+    size_before = np.cumsum(sizes) - sizes
+    chunk_first = (np.cumsum(chunk_samples) - chunk_samples)[sample_chunks]
+    offsets = chunk_offsets[sample_chunks] + size_before - size_before[np.minimum(chunk_first, count - 1)]
+
+    # Sample durations from the (sample_count, sample_delta) runs of stts
+    durations = np.repeat(stbl.stts[:, 1], stbl.stts[:, 0])[:count]
+    if len(durations) < count:
+        last = durations[-1] if len(durations) else 0
+        durations = np.append(durations, np.full(count - len(durations), last))
+
+    table = np.empty(count, dtype=SAMPLE_TABLE_DTYPE)
+    table['offset'] = offsets
+    table['size'] = sizes
+    table['end'] = np.cumsum(durations)
+    table['start'] = table['end'] - durations
+    return table
+
+
+def ticks_to_ms(ticks, timescale):
+    """Converts track timescale ticks to integer milliseconds"""
+    return ticks * 1000 // timescale
 
 
 def get_stream_data(stbl):
     """Get raw payload bytes from stbl atom offsets"""
-    ret_bytes = b''
-    for payload in get_payloads(stbl):
-        ret_bytes += payload[0]
-    return ret_bytes
+    return b''.join(payload[0] for payload in get_payloads(stbl))
 
 
-def find_gpmd_stbl_atom(parser):
-    """Find the stbl atom"""
-    minf_atom = find_gpmd_minf_atom(parser)
+def find_gpmd_stbl_atom(reader):
+    """Find the stbl atom of the GPMF track and decode its sample tables"""
+    minf_atom = find_gpmd_minf_atom(reader)
     if not minf_atom:
+        # No moov at all when the recording was cut by a power loss, the payloads are recovered from mdat
+        return recover_sample_table(reader) if reader.find(b'moov') is None else None
+    mdia_atom, minf = minf_atom
+    stbl = reader.find(b'stbl', *minf)
+    if stbl is None:
+        return None
+    return read_sample_table(reader, stbl, read_timescale(reader, mdia_atom))
+
+
+def find_gpmd_minf_atom(reader):
+    """Find minf atom for GPMF media, returns the (mdia, minf) box ranges"""
+    moov = reader.find(b'moov')
+    if moov is None:
         return None
-    try:
-        for minf_field in minf_atom:
-            tag = minf_field['tag']
-            if tag.value != 'stbl':
-                continue
-            return minf_field['stbl']
-    except MissingField:
-        pass
-
-
-def find_gpmd_minf_atom(parser):
-    """Find minf atom for GPMF media"""
-    def recursive_search(atom):
-        try:
-            subtype = atom['hdlr/subtype']
-            if subtype.value == 'meta':
-                meta_atom = atom.parent
-                # print(meta_atom)
-                for subatom in meta_atom:
-                    tag = subatom['tag']
-                    if tag.value != 'minf':
-                        continue
-                    minf_atom = subatom['minf']
-                    #print("  {}".format(minf_atom))
-                    for minf_field in minf_atom:
-                        tag = minf_field['tag']
-                        #print("    {}".format(tag))
-                        if tag.value != 'gmhd':
-                            continue
-                        if b'gpmd' in minf_field['data'].value:
-                            return minf_atom
-        except MissingField:
-            pass
-        try:
-            for x in atom:
-                ret = recursive_search(x)
-                if ret:
-                    return ret
-        except KeyError as e:
-            pass
+    for box_type, payload, box_end in reader.boxes(*moov):
+        if box_type != b'trak':
+            continue
+        mdia = reader.find(b'mdia', payload, box_end)
+        if mdia is None:
+            continue
+        hdlr = reader.find(b'hdlr', *mdia)
+        # version/flags and pre_defined precede the handler type
+        if hdlr is None or reader.read(hdlr[0] + 8, 4) != b'meta':
+            continue
+        minf = reader.find(b'minf', *mdia)
+        stsd = reader.find_path('stbl/stsd', *minf) if minf else None
+        # version/flags, entry count and first entry size precede its format
+        if stsd is not None and reader.read(stsd[0] + 12, 4) == b'gpmd':
+            return (mdia, minf)
+    return None
+
+
+def read_timescale(reader, mdia):
+    """Read the track timescale from the mdhd atom"""
+    mdhd = reader.find(b'mdhd', *mdia)
+    if mdhd is None:
+        return 1000
+    version = reader.read(mdhd[0], 1)[0]
+    # Creation and modification times are 64-bit in version 1
+    return struct.unpack_from('>I', reader.data, mdhd[0] + (20 if version == 1 else 12))[0]
+
+
+def read_sample_table(reader, stbl, timescale):
+    """Decode the stts/stsc/stsz/stco/co64 tables of stbl in bulk"""
+    tables = {box_type: payload for box_type, payload, _ in reader.boxes(*stbl)}
+
+    def count(box_type):
+        # Entry count follows version/flags
+        return struct.unpack_from('>I', reader.data, tables[box_type] + 4)[0]
+
+    stts = reader.read_table(tables[b'stts'] + 8, count(b'stts'), 2)
+    if b'stsc' in tables:
+        stsc = reader.read_table(tables[b'stsc'] + 8, count(b'stsc'), 3)
+    else:
+        stsc = np.array([[1, 1, 1]], dtype=np.int64)
+    sample_size, sample_count = struct.unpack_from('>II', reader.data, tables[b'stsz'] + 4)
+    if sample_size:
+        stsz = np.full(sample_count, sample_size, dtype=np.int64)
+    else:
+        stsz = reader.read_table(tables[b'stsz'] + 12, sample_count)
+    if b'co64' in tables:
+        chunk_offsets = reader.read_table(tables[b'co64'] + 8, count(b'co64'), dtype='>u8')
+    else:
+        chunk_offsets = reader.read_table(tables[b'stco'] + 8, count(b'stco'))
+    return SampleTable(reader, timescale, stts, stsc, stsz, chunk_offsets)
+
+
+def recover_sample_table(reader):
+    """Rebuilds the sample table of a file without moov by scanning its mdat for DEVC payloads, None if none"""
+    start, end = find_mdat(reader)
+    payloads, stmps = scan_payloads(reader, start, end)
+    if not payloads:
         return None
-    return recursive_search(parser)
+    locations = np.array(payloads, dtype=np.int64)
+    durations = estimate_durations(stmps)
+    return SampleTable(
+        reader, RECOVERY_TIMESCALE, np.column_stack((np.ones_like(durations), durations)),
+        np.array([[1, 1, 1]], dtype=np.int64), locations[:, 1], locations[:, 0],
+    )
+
+
+def find_mdat(reader):
+    """Returns the (payload offset, end) of the top-level mdat, cut to the file size, or the whole file"""
+    pos = 0
+    while pos + 8 <= reader.size:
+        size, box_type = BOX_HEADER.unpack_from(reader.data, pos)
+        header = 8
+        if size == 1 and pos + 16 <= reader.size:
+            size = struct.unpack_from('>Q', reader.data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = reader.size - pos
+        if box_type == b'mdat':
+            # The size of an interrupted mdat may be a placeholder or exceed the file
+            return (pos + header, min(pos + max(size, header), reader.size))
+        if size < header:
+            break
+        pos += size
+    return (0, reader.size)
+
+
+def scan_payloads(reader, start, end):
+    """Finds the DEVC payloads between start and end, returns ([(offset, size)], [{sample FourCC: STMP}])
+
+    Candidates are located with the C-level find of the mapping and kept only if their KLV structure is valid.
+    Adjacent DEVC of different devices (DVID) form one payload, as in a camera with an attached device.
+    """
+    data = reader.data
+    payloads = []
+    stmps = []
+    devices = set()
+    pos = data.find(b'DEVC', start, end)
+    while pos >= 0:
+        devc = read_devc(data, pos, end)
+        if devc is None:
+            pos = data.find(b'DEVC', pos + 1, end)
+            continue
+        devc_end, device_id, streams = devc
+        if payloads and sum(payloads[-1]) == pos and device_id not in devices:
+            payloads[-1] = (payloads[-1][0], devc_end - payloads[-1][0])
+            stmps[-1].update(streams)
+        else:
+            payloads.append((pos, devc_end - pos))
+            stmps.append(streams)
+            devices.clear()
+        devices.add(device_id)
+        pos = data.find(b'DEVC', devc_end, end)
+    return payloads, stmps
+
+
+def read_devc(data, offset, end):
+    """Validates the DEVC KLV at offset, returns (its end, DVID, {sample FourCC: STMP or -1}) or None"""
+    if offset + 8 > end:
+        return None
+    _, type_char, size, repeat = KLV_HEADER.unpack_from(data, offset)
+    devc_end = offset + 8 + size * repeat
+    if type_char != 0 or devc_end > end:
+        return None
+    children = klv_children(data, offset + 8, devc_end)
+    if not children:
+        return None
+    device_id = None
+    streams = {}
+    for key, type_char, payload, length in children:
+        if key == b'DVID':
+            device_id = bytes(data[payload:payload + length])
+        elif key == b'STRM' and type_char == 0:
+            elements = klv_children(data, payload, payload + length)
+            if not elements:
+                return None
+            stmp = [int.from_bytes(data[p:p + n], 'big') for k, _, p, n in elements if k == b'STMP' and n]
+            streams[elements[-1][0]] = stmp[0] if stmp else -1
+    # A DEVC without streams is more likely a chance match than telemetry
+    return (devc_end, device_id, streams) if streams else None
+
+
+def klv_children(data, start, end):
+    """Returns the [(key, type, payload offset, length)] KLVs tiling [start, end), None if they do not"""
+    children = []
+    pos = start
+    while pos < end:
+        if pos + 8 > end:
+            return None
+        key, type_char, size, repeat = KLV_HEADER.unpack_from(data, pos)
+        if not FOURCC_PATTERN.fullmatch(key) or (type_char and type_char not in KLV_TYPES):
+            return None
+        length = size * repeat
+        children.append((key, type_char, pos + 8, length))
+        # Data is padded to 4 bytes
+        pos += 8 + ((length + 3) & ~3)
+    return children if pos == end else None
+
+
+def estimate_durations(stmps):
+    """Returns the payload durations in RECOVERY_TIMESCALE ticks from the STMP of the first stream having one"""
+    fourcc = next((fourcc for streams in stmps for fourcc, stmp in streams.items() if stmp >= 0), None)
+    values = np.array([streams.get(fourcc, -1) for streams in stmps], dtype=np.float64)
+    positions = np.arange(len(values))
+    known = values >= 0
+    if known.sum() >= 2:
+        step = np.median(np.diff(values[known]) / np.diff(positions[known]))
+    else:
+        step = RECOVERY_TIMESCALE
+    if known.any():
+        # Payloads without STMP are interpolated, those before the first or after the last one extrapolated
+        first, last = positions[known][[0, -1]]
+        starts = np.interp(positions, positions[known], values[known])
+        starts = np.where(positions < first, values[first] - (first - positions) * step, starts)
+        starts = np.where(positions > last, values[last] + (positions - last) * step, starts)
+    else:
+        starts = positions * step
+    # STMP going backwards (clock reset) gives no duration, such payloads are assumed to last one step
+    step = max(step, 1)
+    durations = np.append(np.diff(starts), step)
+    return np.round(np.where(durations > 0, durations, step)).astype(np.int64)
 
 
-def recursive_print(input):
-    """Recursively print hachoir parsed state"""
-    print(repr(input))
-    if isinstance(input, String):
-        print("  {}".format(input.display))
-    try:
-        for x in input:
-            recursive_print(x)
-    except KeyError as e:
-        pass
+def recursive_print(reader, start=0, end=None, depth=0):
+    """Recursively print the box tree"""
+    for box_type, payload, box_end in reader.boxes(start, end):
+        print("{}{} @{} ({} bytes)".format('  ' * depth, box_type.decode('latin-1'), payload, box_end - payload))
+        if box_type in CONTAINER_BOXES:
+            recursive_print(reader, payload, box_end, depth + 1)
 
 
 if __name__ == '__main__':
     import sys
-    parser = hachoir.parser.createParser(sys.argv[1])
-    with open(sys.argv[2], 'wb') as fp:
-        fp.write(
-            get_stream_data(
-                find_gpmd_stbl_atom(parser)
+    with MP4Reader(sys.argv[1]) as reader:
+        with open(sys.argv[2], 'wb') as fp:
+            fp.write(
+                get_stream_data(
+                    find_gpmd_stbl_atom(reader)
+                )
             )
-        )
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 """Converts GoPro GPMF data to JSON"""
+import functools
 import json
+import mmap
 import re
 import os
-from extract import get_gpmf_payloads_from_file
-from parse import parse_value, recursive
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+from chapters import chapter_paths, group_chapters, iter_chapter_locations
+from gpmf_index import read_payloads
+from parse import PayloadDecoder
 
 FOURCC_DEFINITIONS = {
     "DVID": "Device/track ID",
@@ -54,6 +59,16 @@ FOURCC_DEFINITIONS = {
     "TMPC": "Device temperature",
 }
 
+# Streams used by the IMU processing stages
+IMU_STREAMS = ("ACCL", "GYRO")
+
+# Version of the columnar stage-1 layout written by convert_file_columnar
+COLUMNAR_VERSION = 2
+# First bytes of a columnar file, followed by the little-endian uint64 length of its JSON header
+COLUMNAR_MAGIC = b"GPMFCOL\0"
+# Arrays start at multiples of this offset in a columnar file
+COLUMNAR_ALIGN = 64
+
 
 def get_valid_input(argv):
     """gets user input, exit program if input is incorrect"""
@@ -88,33 +103,80 @@ def get_valid_input(argv):
     return input_path, output_path
 
 
-def get_gpmf_data(infile):
-    """utilizes python-gpmf code for extraction of GPMF data and puts it in dictionary"""
-    payloads, _ = get_gpmf_payloads_from_file(infile)
-    data = {}
-    for gpmf_data, timestamps in payloads:
-        data_entry = []
-        for element, parents in recursive(gpmf_data):
-            try:
-                value = parse_value(element)
-            except ValueError:
-                value = element.data
-            data_entry.append(
-                ([x.decode("latin-1") for x in list(parents) + [element.key]], value)
-            )
-        data.update({str(timestamps): data_entry})
-    return data
+def get_gpmf_data(infile, streams=None, workers=1):
+    """utilizes python-gpmf code for extraction of GPMF data and puts it in dictionary
+
+    infile is a video file or a sequence of chapter files, whose timestamps then continue across chapters.
+    streams optionally restricts extraction to the STRM containers of these FourCCs (e.g. IMU_STREAMS).
+    workers > 1 decodes contiguous payload ranges in parallel processes, each reading the file itself.
+    Returns {str(timestamps): [GPMFElement]}, element values being decoded when accessed, or with workers > 1
+    {str(timestamps): [DecodedElement]}, values decoded in the workers.
+    """
+    chapters = [(chapter, locations) for chapter, _, locations in iter_chapter_locations(infile)]
+    total = sum(len(locations) for _, locations in chapters)
+    if workers > 1 and total > 1:
+        # A few ranges per worker balances uneven payloads, only offsets are sent to the workers
+        step = -(-total // (workers * 4))
+        args_list = [
+            (chapter, locations[i:i + step], streams)
+            for chapter, locations in chapters
+            for i in range(0, len(locations), step)
+        ]
+        decoded = []
+        for result, error in run_in_pool(decode_payload_values, args_list, workers):
+            if error is not None:
+                raise error
+            decoded.extend(result)
+    else:
+        decoded = [item for chapter, locations in chapters for item in decode_payloads(chapter, locations, streams)]
+    return {str(timestamps): data_entry for timestamps, data_entry in decoded}
+
+
+def decode_payloads(infile, locations, streams=None):
+    """Decodes the payloads of infile at (offset, size, timestamps) locations into [(timestamps, data_entry)]"""
+    return list(iter_decoded_payloads(infile, locations, streams))
+
+
+def decode_payload_values(infile, locations, streams=None):
+    """Same as decode_payloads with the values decoded, for worker processes to leave no decoding to the parent"""
+    return [
+        (timestamps, [element.decoded() for element in data_entry])
+        for timestamps, data_entry in iter_decoded_payloads(infile, locations, streams)
+    ]
+
+
+def iter_session_payloads(infile, streams=None):
+    """Yields (timestamps, data_entry) for the payloads of a video file or of consecutive chapter files, in order"""
+    for chapter, _, locations in iter_chapter_locations(infile):
+        yield from iter_decoded_payloads(chapter, locations, streams)
+
+
+def iter_decoded_payloads(infile, locations, streams=None):
+    """Yields (timestamps, data_entry) for the payloads of infile at (offset, size, timestamps) locations, one at a time
+
+    Payloads are decoded through the plan of a PayloadDecoder, recompiled only when the payload layout changes.
+    data_entry is a list of GPMFElement, whose values are decoded from their raw data when accessed.
+    """
+    decoder = PayloadDecoder(streams)
+    for gpmf_data, timestamps in read_payloads(infile, locations):
+        yield (timestamps, decoder.elements(gpmf_data))
 
 
 def cast_values(key, value):
     """casts values based on the datatype, which is determined by the last element in the key"""
     if key[-1] in ["SIUN", "UNIT", "GPSA", "DVNM"]:
+        # FourCC values (GPSA) are already decoded
+        if type(value) is str:
+            return value
         return (
             "deg, deg, m, m/s, m/s"
             if value == b"degdegm\x00\x00m/sm/s"
             else value.decode("latin-1")
         )
     elif key[-1] in ["STMP", "ORIN", "ORIO"]:
+        # STMP is decoded as uint64, ORIN/ORIO are char and stay raw bytes
+        if type(value) is int:
+            return value
         return int.from_bytes(value, "big")
     elif key[-1] in ["TSMP", "SCAL", "GPSP", "GPSF", "DVID"]:
         if type(value) is list:
@@ -136,6 +198,12 @@ def cast_values(key, value):
         "IORI",
         "GRAV",
         "CORI",
+        "GPS9",
+        "HUES",
+        "SCEN",
+        "MWET",
+        "WNDM",
+        "AALP",
     ]:
         return value
     else:
@@ -144,57 +212,273 @@ def cast_values(key, value):
 
 def process_gpmf_data(gpmf_data):
     """refines GPMF data and optimizes structure for usability with JSON file"""
-    data = []
-    for (key, val) in gpmf_data.items():
-        data_a = [i for i, j in enumerate(val) if "STMP" in j[0]]
-        data_b = [0] + data_a + [len(val)]
-        data_c = list(zip(data_b[:-1], data_b[1:]))
-        data_d = list(map(lambda x: val[x[0] : x[1]], data_c))
-        data_e = (
-            {"Interval in ms": key}
-            | {
-                FOURCC_DEFINITIONS.get(x[0][-1], x[0][-1]): cast_values(x[0], x[1])
-                for x in data_d[0]
-            }
-            | {
-                re.sub("[\(\[].*?[\)\]]", "", x[2][1].decode("latin-1")).strip(): {
-                    FOURCC_DEFINITIONS.get(y[0][-1], y[0][-1]): cast_values(y[0], y[1])
-                    for y in x[:2] + x[3:]
-                }
-                for x in data_d[1:]
-            }
-        )
-        data.append(data_e)
-    return data
+    return [process_gpmf_entry(key, val) for (key, val) in gpmf_data.items()]
+
+
+def process_gpmf_entry(key, val):
+    """refines the GPMFElement list of one payload into its JSON object, in a single pass
+
+    Elements outside of streams are top-level fields. Each STRM container becomes an object named after its
+    STNM, or after its last FourCC when it has none, holding its other elements.
+    """
+    entry = {"Interval in ms": key}
+    streams = []
+    current = None
+    for element in val:
+        path = element.path
+        if element.strm is None:
+            entry[FOURCC_DEFINITIONS.get(path[-1], path[-1])] = cast_values(path, element.value)
+            continue
+        if element.strm != current:
+            current = element.strm
+            stream = [None, {}, None]
+            streams.append(stream)
+        if path[-1] == "STNM" and stream[0] is None:
+            stream[0] = stream_name(element.value)
+        else:
+            stream[1][FOURCC_DEFINITIONS.get(path[-1], path[-1])] = cast_values(path, element.value)
+            stream[2] = path[-1]
+    for name, fields, last in streams:
+        entry[name if name is not None else FOURCC_DEFINITIONS.get(last, last)] = fields
+    return entry
+
 
+@functools.lru_cache(maxsize=None)
+def stream_name(stnm):
+    """Returns the JSON key of a stream from its STNM value, without bracketed units, computed once per name"""
+    return re.sub(r"[\(\[].*?[\)\]]", "", stnm.decode("latin-1")).strip()
 
-def get_conv_files_list(input_path, output_path):
-    """prepares list in [(input_path, output_path)] format for conversion"""
+
+def write_json_stream(entries, fp):
+    """Writes an iterable of JSON objects as a list, byte for byte like json.dumps(list(entries), indent=4)"""
+    first = True
+    for entry in entries:
+        # Nested one level down, every line of the object gets one more indent
+        fp.write("[\n    " if first else ",\n    ")
+        fp.write(json.dumps(entry, indent=4, ensure_ascii=False).replace("\n", "\n    "))
+        first = False
+    fp.write("[]" if first else "\n]")
+
+
+def get_conv_files_list(input_path, output_path, output_format="json"):
+    """prepares list in [(input_path, output_path)] format for conversion, output_format being json or col"""
     output_dir = os.path.join(os.path.dirname(output_path), "1-IMU-Json-Extract")
     os.makedirs(output_dir, exist_ok=True)
     
     if os.path.isdir(input_path):
+        # Chapters of one recording become a single input, a tuple of their paths, named after the first one
         return list(
             map(
                 lambda x: (
-                    os.path.join(input_path, x),
-                    os.path.join(output_dir, os.path.splitext(x)[0] + ".json"),
+                    os.path.join(input_path, x[0]) if len(x) == 1 else tuple(os.path.join(input_path, y) for y in x),
+                    os.path.join(output_dir, os.path.splitext(x[0])[0] + "." + output_format),
                 ),
-                filter(
-                    lambda y: not os.path.isdir(y)
-                    and os.path.splitext(y)[1].lower() in [".mp4", ".mov"],
-                    os.listdir(input_path),
+                group_chapters(
+                    filter(
+                        lambda y: not os.path.isdir(y)
+                        and os.path.splitext(y)[1].lower() in [".mp4", ".mov"],
+                        sorted(os.listdir(input_path)),
+                    )
                 ),
             )
         )
+    elif output_format != "json":
+        output_name = os.path.splitext(os.path.basename(output_path))[0] + "." + output_format
+        return [(input_path, os.path.join(output_dir, output_name))]
     else:
         return [(input_path, os.path.join(output_dir, os.path.basename(output_path)))]
 
 
-def process_video_to_json(input_path, output_path):
-    """Main function to process video file(s) to JSON"""
-    input_path = os.path.abspath(input_path)
+def convert_file(infile, outfile, streams=None, workers=1):
+    """Converts one video file to its JSON (or columnar .col) output file, decoding its payloads in `workers` processes
+
+    infile may be a sequence of chapter files, converted as one recording. With a single worker payloads are
+    decoded and written one at a time, so memory does not grow with the recording length.
+    """
+    if os.path.splitext(outfile)[1].lower() == ".col":
+        return convert_file_columnar(infile, outfile, streams)
+    if workers > 1:
+        data = process_gpmf_data(get_gpmf_data(infile, streams, workers))
+        with open(outfile, "w", encoding="utf-8") as fp:
+            fp.write(json.dumps(data, indent=4, ensure_ascii=False))
+        return outfile
+    decoded = iter_session_payloads(infile, streams)
+    with open(outfile, "w", encoding="utf-8") as fp:
+        write_json_stream((process_gpmf_entry(str(timestamps), data_entry) for timestamps, data_entry in decoded), fp)
+    return outfile
+
+
+def convert_file_columnar(infile, outfile, streams=None):
+    """Writes the numeric streams of a video file as a flat columnar .col file, see write_columnar
+
+    Arrays, P being the number of payloads and N the number of samples of a stream:
+      intervals         int64 [P, 2] payload (start, end) in ms
+      FOURCC            [N, k] samples in their native (unscaled) type, all payloads concatenated
+      FOURCC/count      int64 [P] samples of each payload
+      FOURCC/stmp       int64 [P] STMP timestamp in microseconds, -1 if absent
+      FOURCC/tsmp       int64 [P] TSMP total samples delivered, -1 if absent
+      FOURCC/scale      float64 SCAL factors
+    The header meta holds {"version", "source", "streams": {FOURCC: {"name", "units", "type",
+    "input_orientation", "output_orientation"}}}. Streams whose samples are not plain numbers (complex TYPE, text) are left out. A sequence of chapter files
+    is written as one recording, intervals continuing across chapters.
+    """
+    chapters = chapter_paths(infile)
+    meta = {"version": COLUMNAR_VERSION, "source": os.path.basename(chapters[0]), "streams": {}}
+    if len(chapters) > 1:
+        meta["chapters"] = [os.path.basename(chapter) for chapter in chapters]
+    intervals = []
+    columns = {}
+    for chapter, index, locations in iter_chapter_locations(infile):
+        payload_count = len(intervals)
+        intervals.extend(timestamps for _, _, timestamps in locations)
+        with open(chapter, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for fourcc, stream in index.streams.items():
+                if streams is not None and fourcc not in streams:
+                    continue
+                try:
+                    dtype, width = stream.dtype()
+                except ValueError:
+                    continue
+                column = columns.get(fourcc)
+                if column is None:
+                    # Payloads of earlier chapters without this stream hold no samples
+                    column = columns[fourcc] = {
+                        "dtype": dtype, "width": width, "scale": stream.scale, "samples": [],
+                        "count": [np.zeros(payload_count, dtype=np.int64)],
+                        "stmp": [np.full(payload_count, -1, dtype=np.int64)],
+                        "tsmp": [np.full(payload_count, -1, dtype=np.int64)],
+                    }
+                    meta["streams"][fourcc] = {
+                        "name": stream.name, "units": stream.units, "type": stream.type_char,
+                        "input_orientation": stream.input_orientation,
+                        "output_orientation": stream.output_orientation,
+                    }
+                # astype copies each payload's samples out of the mapping, in native byte order
+                column["samples"].extend(
+                    np.frombuffer(data, dtype=dtype, count=count * width, offset=offset).astype(dtype.newbyteorder("="))
+                    for offset, count in zip(stream.offset.tolist(), stream.count.tolist())
+                    if offset >= 0
+                )
+                for field in ("count", "stmp", "tsmp"):
+                    column[field].append(getattr(stream, field))
+        for column in columns.values():
+            # Streams missing from this chapter
+            missing = len(intervals) - sum(len(counts) for counts in column["count"])
+            if missing:
+                column["count"].append(np.zeros(missing, dtype=np.int64))
+                column["stmp"].append(np.full(missing, -1, dtype=np.int64))
+                column["tsmp"].append(np.full(missing, -1, dtype=np.int64))
+
+    arrays = {"intervals": np.array(intervals, dtype=np.int64).reshape(-1, 2)}
+    for fourcc, column in columns.items():
+        width = column["width"]
+        arrays[fourcc] = (np.concatenate(column["samples"]).reshape(-1, width) if column["samples"]
+                          else np.empty((0, width), column["dtype"]))
+        for field in ("count", "stmp", "tsmp"):
+            arrays[fourcc + "/" + field] = np.concatenate(column[field])
+        arrays[fourcc + "/scale"] = column["scale"]
+    return write_columnar(outfile, meta, arrays)
+
+
+def write_columnar(outfile, meta, arrays):
+    """Writes {name: array} and meta as a flat columnar file that np.memmap maps without copying
+
+    Layout:
+      magic             8 bytes COLUMNAR_MAGIC
+      header length     little-endian uint64
+      header            UTF-8 JSON: meta plus "arrays": {name: {"dtype", "shape", "offset"}}
+      data              from the first multiple of COLUMNAR_ALIGN after the header, each C-ordered array at
+                        its offset from the start of data, offsets being multiples of COLUMNAR_ALIGN
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // COLUMNAR_ALIGN) * COLUMNAR_ALIGN
+    header = json.dumps(dict(meta, arrays=layout)).encode("utf-8")
+    start = columnar_data_start(len(header))
+    with open(outfile, "wb") as fp:
+        fp.write(COLUMNAR_MAGIC + len(header).to_bytes(8, "little") + header)
+        for name, array in arrays.items():
+            fp.write(bytes(start + layout[name]["offset"] - fp.tell()))
+            fp.write(array.tobytes())
+    return outfile
+
+
+def columnar_data_start(header_length):
+    """Returns the file offset of the data of a columnar file whose JSON header is header_length bytes long"""
+    return -(-(len(COLUMNAR_MAGIC) + 8 + header_length) // COLUMNAR_ALIGN) * COLUMNAR_ALIGN
+
+
+def load_columnar(path):
+    """Opens a columnar stage-1 .col file, returns (meta, {name: array}) with arrays memory-mapped read-only
+
+    No file handle stays open, each array keeping its own mapping alive.
+    """
+    with open(path, "rb") as fp:
+        if fp.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError("Not a columnar file: {}".format(path))
+        header_length = int.from_bytes(fp.read(8), "little")
+        meta = json.loads(fp.read(header_length).decode("utf-8"))
+    if meta.get("version") != COLUMNAR_VERSION:
+        raise ValueError("Unsupported columnar file version: {}".format(meta.get("version")))
+    start = columnar_data_start(header_length)
+    arrays = {}
+    for name, entry in meta.pop("arrays").items():
+        dtype, shape = np.dtype(entry["dtype"]), tuple(entry["shape"])
+        # np.memmap cannot map an empty array
+        arrays[name] = (np.memmap(path, dtype=dtype, mode="r", offset=start + entry["offset"], shape=shape)
+                        if np.prod(shape) else np.empty(shape, dtype=dtype))
+    return meta, arrays
+
+
+def run_in_pool(func, args_list, workers):
+    """Runs func(*args) for every args in a process pool, with at most 2 * workers tasks in flight
+
+    Returns [(result, error)] in the order of args_list, error being None on success and result None on failure.
+    """
+    outcomes = [None] * len(args_list)
+    pending = {}
+    todo = iter(enumerate(args_list))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            for idx, args in todo:
+                pending[executor.submit(func, *args)] = idx
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx = pending.pop(future)
+                error = future.exception()
+                outcomes[idx] = (None, error) if error else (future.result(), None)
+    return outcomes
+
+
+def process_video_to_json(input_path, output_path, streams=None, workers=1, output_format="json"):
+    """Main function to process video file(s) to JSON, streams optionally restricts the extracted FourCCs
+
+    output_format "col" writes the columnar layout of convert_file_columnar instead of JSON.
+
+    For a single file, workers > 1 decodes its payloads in parallel processes. In directory mode, workers > 1
+    converts files in parallel processes: a failing file does not stop the others, failures are reported in a
+    summary and the written files are returned in input order.
+
+    input_path may also be a sequence of chapter files, converted as one recording. In directory mode the
+    chapters of each recording (GH01xxxx, GH02xxxx, ...) are grouped the same way.
+    """
     output_path = os.path.abspath(output_path)
+    if isinstance(input_path, (list, tuple)):
+        # Chapters of one recording, converted to a single output file named after the first chapter
+        chapters = tuple(os.path.abspath(chapter) for chapter in input_path)
+        for chapter in chapters:
+            if not os.path.isfile(chapter):
+                raise FileNotFoundError("Input file does not exist: {}".format(chapter))
+        outfile = get_conv_files_list(chapters[0], output_path, output_format)[0][1]
+        return [convert_file(chapters, outfile, streams, workers)]
+    input_path = os.path.abspath(input_path)
     
     # Validate inputs
     if not os.path.exists(input_path):
@@ -205,20 +489,31 @@ def process_video_to_json(input_path, output_path):
         raise ValueError("Input and output must both be either files or directories")
         
     # Process files
-    files = get_conv_files_list(input_path, output_path)
-    results = []
-    
-    for infile, outfile in files:
-        data = process_gpmf_data(get_gpmf_data(infile))
-        with open(outfile, "w", encoding="utf-8") as fp:
-            fp.write(json.dumps(data, indent=4, ensure_ascii=False))
-        results.append(outfile)
-    
+    files = get_conv_files_list(input_path, output_path, output_format)
+    if not os.path.isdir(input_path):
+        return [convert_file(infile, outfile, streams, workers) for infile, outfile in files]
+
+    args_list = [(infile, outfile, streams) for infile, outfile in files]
+    if workers > 1 and len(files) > 1:
+        outcomes = run_in_pool(convert_file, args_list, workers)
+    else:
+        outcomes = []
+        for args in args_list:
+            try:
+                outcomes.append((convert_file(*args), None))
+            except Exception as e:
+                outcomes.append((None, e))
+
+    results = [result for result, error in outcomes if error is None]
+    failures = [(infile, error) for (infile, _), (_, error) in zip(files, outcomes) if error is not None]
+    print("Converted {}/{} files".format(len(results), len(files)))
+    for infile, error in failures:
+        print("ERROR: {}: {}".format(os.path.basename(chapter_paths(infile)[0]), error))
     return results
 
 if __name__ == "__main__":
     import sys
     try:
-        process_video_to_json(sys.argv[1], sys.argv[2])
+        process_video_to_json(sys.argv[1], sys.argv[2], workers=int(sys.argv[3]) if len(sys.argv) > 3 else 1)
     except IndexError:
-        print('ERROR: two inputs are required.\nUse the format "python gpmf2json.py [input mp4/mov file] [output json file]" for a single file\nor  "python gpmf2json.py [input directory] [output directory]" for batch processing.')
+        print('ERROR: two inputs are required.\nUse the format "python gpmf2json.py [input mp4/mov file] [output json file]" for a single file\nor  "python gpmf2json.py [input directory] [output directory] [workers]" for batch processing.')
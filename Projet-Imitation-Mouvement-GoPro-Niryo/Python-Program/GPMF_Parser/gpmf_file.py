@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""Lazy access to the devices and streams of a GPMF track
+
+    with GPMFFile("GX010042.MP4") as gpmf:
+        print(gpmf.devices)                   # from the sidecar index, no payload decoded
+        accl = gpmf.streams["ACCL"]
+        print(accl.name, accl.rate)
+        samples = accl.samples                # decoded on first access, then cached
+"""
+import collections
+import mmap
+import numpy as np
+from gpmf_index import open_index
+from parse import Q_SCALES, TYPE_NAMES
+from timing import fit_clock
+
+# Decoded arrays kept by a GPMFFile, least recently used ones are dropped beyond this size
+DEFAULT_CACHE_BYTES = 64 * 1024 ** 2
+
+# DEVC container of a file, streams being the FourCCs it holds
+Device = collections.namedtuple('Device', ['id', 'name', 'streams'])
+
+
+class GPMFStream:
+    """One stream of a GPMFFile, its samples being read from the file only when accessed"""
+
+    def __init__(self, gpmf_file, index):
+        self.file = gpmf_file
+        self.index = index
+
+    def __repr__(self):
+        return "<GPMFStream {} '{}' {} samples>".format(self.fourcc, self.name, self.count)
+
+    @property
+    def fourcc(self):
+        return self.index.fourcc
+
+    @property
+    def name(self):
+        return self.index.name
+
+    @property
+    def units(self):
+        return self.index.units
+
+    @property
+    def input_orientation(self):
+        """ORIN of the stream, "" if absent"""
+        return self.index.input_orientation
+
+    @property
+    def output_orientation(self):
+        """ORIO of the stream, "" if absent"""
+        return self.index.output_orientation
+
+    @property
+    def device_id(self):
+        return self.index.device_id
+
+    @property
+    def count(self):
+        """Total number of samples"""
+        return int(self.index.count.sum())
+
+    @property
+    def rate(self):
+        """Mean sample rate in Hz"""
+        duration_s = self.file.duration_ms / 1000.0
+        return float(self.count / duration_s) if duration_s else 0.0
+
+    @property
+    def raw(self):
+        """Samples [N, k] in their native type, unscaled"""
+        return self.file.cached((self.fourcc, "raw"), lambda: self.read_raw(0, len(self.index.count)))
+
+    @property
+    def samples(self):
+        """Samples [N, k] as float64, divided by SCAL (and by the fixed point unit of Q types)"""
+        return self.file.cached((self.fourcc, "samples"), lambda: self.raw / self.scale())
+
+    @property
+    def timestamps(self):
+        """Timestamps in ms of the samples, spread evenly over the interval of their payload"""
+        return self.file.cached((self.fourcc, "timestamps"), lambda: self.sample_times(0, len(self.index.count)))
+
+    @property
+    def clock(self):
+        """Sensor clock of the stream fitted on the STMP/TSMP of its payloads (see timing)"""
+        return fit_clock(self.index.stmp, self.index.tsmp, self.index.count)
+
+    @property
+    def sensor_timestamps(self):
+        """Timestamps in ms of the samples on the sensor clock, exact when sample counts vary between payloads"""
+        return self.file.cached((self.fourcc, "sensor_timestamps"),
+                                lambda: self.clock.sample_times_us(self.index.count) / 1000.0)
+
+    def scale(self):
+        """Returns the divisor of the raw samples"""
+        return self.index.scale * Q_SCALES.get(TYPE_NAMES.get(ord(self.index.type_char)), 1.0)
+
+    def read(self, t0_ms, t1_ms):
+        """Reads the samples within [t0_ms, t1_ms), returns (timestamps in ms, scaled samples[N, k])
+
+        Only the payloads overlapping the range are read, nothing is cached.
+        """
+        starts, ends = self.file.payload_times_ms()
+        # Payloads are sorted by time, keep those ending after t0 and starting before t1
+        first = np.searchsorted(ends, t0_ms, side='right')
+        last = max(first, np.searchsorted(starts, t1_ms, side='left'))
+        timestamps = self.sample_times(first, last)
+        samples = self.read_raw(first, last) / self.scale()
+        keep = (timestamps >= t0_ms) & (timestamps < t1_ms)
+        return timestamps[keep], samples[keep]
+
+    def read_raw(self, first, last):
+        """Reads the native samples of payloads [first, last) into one [N, k] array"""
+        dtype, width = self.index.dtype()
+        data = self.file.data
+        # astype copies each payload's samples out of the mapping, in native byte order
+        samples = [
+            np.frombuffer(data, dtype=dtype, count=count * width, offset=offset).astype(dtype.newbyteorder("="))
+            for offset, count in zip(self.index.offset[first:last].tolist(), self.index.count[first:last].tolist())
+            if offset >= 0 and count
+        ]
+        if not samples:
+            return np.empty((0, width), dtype.newbyteorder("="))
+        return np.concatenate(samples).reshape(-1, width)
+
+    def sample_times(self, first, last):
+        """Returns the timestamps in ms of the samples of payloads [first, last)"""
+        starts, ends = self.file.payload_times_ms()
+        starts, ends = starts[first:last], ends[first:last]
+        counts = np.where(self.index.offset[first:last] >= 0, self.index.count[first:last], 0)
+        # Position of every sample within its payload
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(starts, counts) + np.repeat((ends - starts) / np.maximum(counts, 1), counts) * positions
+
+
+class GPMFFile:
+    """GPMF track of a video file, indexed on open and decoded on access
+
+    The sidecar index (see gpmf_index) gives the devices, streams, sample counts and rates without decoding any
+    payload. Sample arrays are decoded from a memory map when first accessed and cached up to cache_bytes.
+    """
+
+    def __init__(self, filepath, cache_bytes=DEFAULT_CACHE_BYTES):
+        self.filepath = filepath
+        self.index = open_index(filepath)
+        self.streams = {fourcc: GPMFStream(self, stream) for fourcc, stream in self.index.streams.items()}
+        self.cache_bytes = cache_bytes
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.times = None
+        self.file = None
+        self.mapping = None
+
+    def __repr__(self):
+        return "<GPMFFile {} {} streams>".format(self.filepath, len(self.streams))
+
+    def __getitem__(self, fourcc):
+        return self.streams[fourcc]
+
+    def __contains__(self, fourcc):
+        return fourcc in self.streams
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Unmaps the file, cached arrays are copies and stay valid"""
+        if self.mapping is not None:
+            self.mapping.close()
+            self.file.close()
+            self.mapping = None
+            self.file = None
+
+    @property
+    def data(self):
+        """Memory map of the file, opened on first use"""
+        if self.mapping is None:
+            self.file = open(self.filepath, 'rb')
+            self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mapping
+
+    @property
+    def devices(self):
+        """Devices of the file as {DVID: Device}"""
+        devices = {}
+        for fourcc, stream in self.index.streams.items():
+            device = devices.setdefault(stream.device_id, Device(stream.device_id, stream.device_name, []))
+            device.streams.append(fourcc)
+        return devices
+
+    @property
+    def duration_ms(self):
+        """Time from the start of the first payload to the end of the last one"""
+        starts, ends = self.payload_times_ms()
+        return float(ends[-1] - starts[0]) if len(starts) else 0.0
+
+    def payload_times_ms(self):
+        """Returns the (start, end) arrays of the payloads in ms"""
+        if self.times is None:
+            self.times = self.index.payload_times_ms()
+        return self.times
+
+    def cached(self, key, compute):
+        """Returns the cached array of key, computing it with compute() and evicting old arrays on a miss"""
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        value = compute()
+        if value.nbytes <= self.cache_bytes:
+            self.cache[key] = value
+            self.cached_bytes += value.nbytes
+            while self.cached_bytes > self.cache_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.cached_bytes -= evicted.nbytes
+        return value
+
+
+if __name__ == '__main__':
+    import sys
+    with GPMFFile(sys.argv[1]) as gpmf:
+        for device in gpmf.devices.values():
+            print("Device {} {}".format(device.id, device.name))
+            for fourcc in device.streams:
+                stream = gpmf.streams[fourcc]
+                print("  {} {} ({}): {} samples, {:.1f} Hz".format(
+                    fourcc, stream.name, stream.units, stream.count, stream.rate))
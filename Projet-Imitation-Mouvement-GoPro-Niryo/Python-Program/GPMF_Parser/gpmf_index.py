@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""Persistent sidecar index of the GPMF streams of a video file
+
+The index is written next to the video as <video>.gpmfidx, an uncompressed .npz archive holding:
+  meta                JSON header (format version, file size/mtime, moov hash, timescale, stream attributes
+                      including the DVID/DVNM of their device and the ORIN/ORIO of IMU streams)
+  payloads            per-payload (offset, size, start, end) table, times in track timescale ticks
+  <FOURCC>/offset     per-payload absolute file offset of the stream samples, -1 if absent
+  <FOURCC>/count      per-payload sample count
+  <FOURCC>/stmp       per-payload STMP timestamp in microseconds, -1 if absent
+  <FOURCC>/tsmp       per-payload TSMP total samples delivered, -1 if absent
+  <FOURCC>/scale      SCAL factors of the stream
+"""
+import hashlib
+import json
+import os
+import numpy as np
+from extract import SAMPLE_TABLE_DTYPE, MP4Reader, build_sample_table, find_gpmd_stbl_atom, ticks_to_ms
+from parse import NUMPY_TYPES, TYPE_NAMES, Element, parse_value, walk_klv
+
+INDEX_VERSION = 3
+INDEX_SUFFIX = ".gpmfidx"
+
+
+class StreamIndex:
+    """Per-payload locations and metadata of one GPMF stream"""
+
+    def __init__(self, fourcc, type_char, size, name, units, device_id, device_name, scale, offset, count, stmp, tsmp,
+                 input_orientation="", output_orientation=""):
+        self.fourcc = fourcc
+        self.type_char = type_char
+        self.size = size
+        self.name = name
+        self.units = units
+        # DVID and DVNM of the DEVC container of the stream, -1 and "" if absent
+        self.device_id = device_id
+        self.device_name = device_name
+        self.scale = scale
+        self.offset = offset
+        self.count = count
+        self.stmp = stmp
+        self.tsmp = tsmp
+        # ORIN and ORIO of the stream (see orientation), "" if absent
+        self.input_orientation = input_orientation
+        self.output_orientation = output_orientation
+
+    def dtype(self):
+        """Returns the NumPy dtype of the stream samples and the number of values per sample"""
+        dtype = NUMPY_TYPES.get(TYPE_NAMES.get(ord(self.type_char)))
+        if dtype is None or dtype.kind == 'S' or self.size % dtype.itemsize:
+            raise ValueError("{} samples of type '{}' cannot be read as an array".format(self.fourcc, self.type_char))
+        return dtype, self.size // dtype.itemsize
+
+
+class GPMFIndex:
+    """Payload table and stream index of a video file"""
+
+    def __init__(self, filepath, file_size, mtime_ns, moov_hash, timescale, payloads, streams):
+        self.filepath = filepath
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+        self.moov_hash = moov_hash
+        self.timescale = timescale
+        self.payloads = payloads
+        self.streams = streams
+
+    def payload_times_ms(self):
+        """Returns the (start, end) arrays of the payloads in ms"""
+        return (self.payloads['start'] * 1000.0 / self.timescale, self.payloads['end'] * 1000.0 / self.timescale)
+
+    def is_valid_for(self, filepath):
+        """Checks the index against the size and mtime of filepath, then against its moov hash if only mtime changed"""
+        stat = os.stat(filepath)
+        if stat.st_size != self.file_size:
+            return False
+        if stat.st_mtime_ns == self.mtime_ns:
+            return True
+        with MP4Reader(filepath) as reader:
+            return get_moov_hash(reader) == self.moov_hash
+
+    def save(self, path):
+        """Writes the index to path, replacing any previous file atomically"""
+        meta = {
+            "version": INDEX_VERSION,
+            "file_size": self.file_size,
+            "mtime_ns": self.mtime_ns,
+            "moov_hash": self.moov_hash,
+            "timescale": self.timescale,
+            "streams": {
+                fourcc: {
+                    "type": stream.type_char, "size": stream.size, "name": stream.name, "units": stream.units,
+                    "device_id": stream.device_id, "device_name": stream.device_name,
+                    "input_orientation": stream.input_orientation, "output_orientation": stream.output_orientation,
+                }
+                for fourcc, stream in self.streams.items()
+            },
+        }
+        arrays = {"meta": np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8), "payloads": self.payloads}
+        for fourcc, stream in self.streams.items():
+            for field in ("offset", "count", "stmp", "tsmp", "scale"):
+                arrays["{}/{}".format(fourcc, field)] = getattr(stream, field)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fp:
+            np.savez(fp, **arrays)
+        os.replace(tmp_path, path)
+
+
+def index_path(filepath):
+    """Returns the sidecar index path of a video file"""
+    return filepath + INDEX_SUFFIX
+
+
+def get_moov_hash(reader):
+    """Hashes the moov box, which holds every sample table of the file"""
+    moov = reader.find(b'moov')
+    if moov is None:
+        return None
+    return hashlib.blake2b(reader.read(moov[0], moov[1] - moov[0]), digest_size=16).hexdigest()
+
+
+def open_index(filepath, rebuild=False):
+    """Returns the index of filepath from its sidecar when still valid, otherwise builds and writes it"""
+    path = index_path(filepath)
+    if not rebuild and os.path.exists(path):
+        index = load_index(path, filepath)
+        if index is not None and index.is_valid_for(filepath):
+            return index
+    index = build_index(filepath)
+    try:
+        index.save(path)
+    except OSError:
+        # Read-only media, use the index for this run only
+        pass
+    return index
+
+
+def get_indexed_payloads(filepath):
+    """Yields the same (payload, (start ms, end ms)) items as extract.get_payloads, located through the index"""
+    return read_payloads(filepath, get_payload_locations(filepath))
+
+
+def get_payload_locations(filepath, index=None):
+    """Returns the [(offset, size, (start ms, end ms))] locations of the payloads of filepath, from index if given"""
+    if index is None:
+        index = open_index(filepath)
+    starts = ticks_to_ms(index.payloads['start'], index.timescale).tolist()
+    ends = ticks_to_ms(index.payloads['end'], index.timescale).tolist()
+    return list(zip(index.payloads['offset'].tolist(), index.payloads['size'].tolist(), zip(starts, ends)))
+
+
+def read_payloads(filepath, locations):
+    """Yields (payload, timestamps) for each (offset, size, timestamps) location, reading filepath directly"""
+    with open(filepath, 'rb') as fp:
+        for offset, size, timestamps in locations:
+            fp.seek(offset)
+            yield (fp.read(size), timestamps)
+
+
+def load_index(path, filepath):
+    """Loads a sidecar index, returns None if it is unreadable or of another format version"""
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            meta = json.loads(npz["meta"].tobytes().decode("utf-8"))
+            if meta.get("version") != INDEX_VERSION:
+                return None
+            streams = {
+                fourcc: StreamIndex(
+                    fourcc, attrs["type"], attrs["size"], attrs["name"], attrs["units"],
+                    attrs["device_id"], attrs["device_name"],
+                    *(npz["{}/{}".format(fourcc, field)] for field in ("scale", "offset", "count", "stmp", "tsmp")),
+                    attrs["input_orientation"], attrs["output_orientation"]
+                )
+                for fourcc, attrs in meta["streams"].items()
+            }
+            return GPMFIndex(
+                filepath, meta["file_size"], meta["mtime_ns"], meta["moov_hash"], meta["timescale"],
+                npz["payloads"].astype(SAMPLE_TABLE_DTYPE), streams,
+            )
+    except Exception:
+        # A truncated or corrupt archive raises BadZipFile, EOFError, NotImplementedError... the index is rebuilt
+        return None
+
+
+def build_index(filepath):
+    """Walks every payload of filepath once and records where each stream's samples are"""
+    stat = os.stat(filepath)
+    with MP4Reader(filepath) as reader:
+        stbl = find_gpmd_stbl_atom(reader)
+        if stbl is None:
+            raise ValueError("No GPMF track found in {}".format(filepath))
+        payloads = build_sample_table(stbl)
+        entries = {}
+        for idx, (offset, size) in enumerate(zip(payloads['offset'].tolist(), payloads['size'].tolist())):
+            for fourcc, entry in index_payload(reader.read(offset, size)).items():
+                entry["offset"] += offset
+                entries.setdefault(fourcc, {})[idx] = entry
+        moov_hash = get_moov_hash(reader)
+
+    streams = {}
+    for fourcc, by_payload in entries.items():
+        first = next(iter(by_payload.values()))
+        streams[fourcc] = StreamIndex(
+            fourcc, first["type"], first["size"], first["name"], first["units"],
+            first["device_id"], first["device_name"], first["scale"],
+            *(payload_column(by_payload, field, default, len(payloads))
+              for field, default in (("offset", -1), ("count", 0), ("stmp", -1), ("tsmp", -1))),
+            first["input_orientation"], first["output_orientation"]
+        )
+    return GPMFIndex(filepath, stat.st_size, stat.st_mtime_ns, moov_hash, stbl.timescale, payloads, streams)
+
+
+def payload_column(by_payload, field, default, count):
+    """Gathers field of the {payload index: entry} dict into a per-payload int64 array"""
+    values = np.full(count, default, dtype=np.int64)
+    values[list(by_payload)] = [entry[field] for entry in by_payload.values()]
+    return values
+
+
+def index_payload(gpmf_data):
+    """Indexes the STRM containers of one payload, keyed by the FourCC of their last (sample) element"""
+    view = memoryview(gpmf_data)
+    entries = {}
+    for devc in walk_klv(view):
+        if devc.type != 0:
+            continue
+        device_id = -1
+        device_name = ""
+        for strm in walk_klv(view, devc.offset, devc.offset + devc.length):
+            # Device attributes precede its streams
+            if strm.key == b'DVID':
+                device_id = read_int(view, strm, -1)
+            elif strm.key == b'DVNM':
+                device_name = read_text(view, strm)
+            if strm.key != b'STRM' or strm.type != 0:
+                continue
+            meta = {}
+            element = None
+            for element in walk_klv(view, strm.offset, strm.offset + strm.length):
+                meta[element.key] = element
+            if element is None or element.type == 0:
+                continue
+            entries[element.key.decode('latin-1')] = {
+                "type": chr(element.type),
+                "size": element.size,
+                "offset": element.offset,
+                "count": element.repeat,
+                "stmp": read_int(view, meta.get(b'STMP'), -1),
+                "tsmp": read_int(view, meta.get(b'TSMP'), -1),
+                "scale": read_scale(view, meta.get(b'SCAL')),
+                "name": read_text(view, meta.get(b'STNM')),
+                "units": read_text(view, meta.get(b'SIUN') or meta.get(b'UNIT')),
+                "device_id": device_id,
+                "device_name": device_name,
+                "input_orientation": read_text(view, meta.get(b'ORIN')),
+                "output_orientation": read_text(view, meta.get(b'ORIO')),
+            }
+    return entries
+
+
+def read_int(view, klv, default):
+    """Reads a single unsigned big-endian integer element"""
+    if klv is None or not klv.length:
+        return default
+    return int.from_bytes(view[klv.offset:klv.offset + klv.length], "big")
+
+
+def read_scale(view, klv):
+    """Reads SCAL factors as a float64 array, 1 if absent"""
+    if klv is None:
+        return np.ones(1)
+    try:
+        return parse_value(element_of(view, klv), as_array=True).astype(np.float64).ravel()
+    except ValueError:
+        return np.ones(1)
+
+
+def read_text(view, klv):
+    """Reads a char element as text"""
+    if klv is None:
+        return ""
+    return bytes(view[klv.offset:klv.offset + klv.length]).rstrip(b"\0").decode("latin-1")
+
+
+def element_of(view, klv):
+    """Builds the Element of a KLV record for parse_value"""
+    return Element(klv.key, klv.type, klv.size, klv.repeat, view[klv.offset:klv.offset + klv.length])
+
+
+if __name__ == '__main__':
+    import sys
+    index = open_index(sys.argv[1], rebuild="--rebuild" in sys.argv)
+    print("{} payloads, index at {}".format(len(index.payloads), index_path(sys.argv[1])))
+    for fourcc, stream in index.streams.items():
+        print("{} {} ({}): {} samples".format(fourcc, stream.name, stream.units, int(stream.count.sum())))
@@ -1,8 +1,19 @@
+import json
 import os
 import sys
-from gpmf2json import process_video_to_json
-from IMU_parser import get_gyro_accel_data, reorder_data
-from adapt_json_niryo import convert_to_robot_format, save_movements_to_json
+from cache import StageCache, file_fingerprint, make_key
+from chapters import chapter_paths, group_chapters
+from gpmf2json import IMU_STREAMS, get_conv_files_list, process_video_to_json, run_in_pool
+from IMU_parser import AXIS_REMAP, IMUSeries, get_gyro_accel_data, reorder_data
+from adapt_json_niryo import IMUProcessor, convert_to_robot_format, save_movements_to_json
+from orientation import OrientationProvider
+
+# Le montage de la caméra passé à reorder_data est AXIS_REMAP de IMU_parser, qui fait partie de la clé de cache
+# Remappage relatif au boîtier de la caméra (ORIN/ORIO des flux) plutôt qu'aux voies du capteur
+USE_ORIENTATION = False
+# Roll, pitch, yaw des mouvements tirés de l'orientation de la caméra (CORI, GRAV, ou GYRO intégré) plutôt que
+# des vitesses brutes du gyroscope, fait partie de la clé de cache
+CAMERA_ORIENTATION = True
 
 def display_intro():
     """Display the project introduction and wait for user input"""
@@ -53,35 +64,119 @@ def ensure_directories():
         created_dirs[dir_name] = dir_path
     return created_dirs
 
-def process_gopro_video(video_path, output_path=None):
+def get_stage_keys(video_path, streams, output_format, sampling_rate):
+    """Clés de cache des trois étapes, chacune dérivée de la précédente et de ses propres paramètres"""
+    processor = IMUProcessor()
+    fingerprints = [file_fingerprint(chapter) for chapter in chapter_paths(video_path)]
+    # streams est un ensemble ou une séquence de FourCC, None pour tous les flux
+    extract_key = make_key("extract", fingerprints, sorted(streams) if streams is not None else None, output_format)
+    reorder_key = make_key("reorder", extract_key, AXIS_REMAP, USE_ORIENTATION)
+    convert_key = make_key("convert", reorder_key, sampling_rate, CAMERA_ORIENTATION,
+                           processor.dt, processor.cutoff_freq, processor.filter_order)
+    return extract_key, reorder_key, convert_key
+
+def get_orientation(video_path):
+    """Orientation de la caméra d'une vidéo d'un seul fichier (voir orientation), None si indisponible
+
+    Les chapitres d'un enregistrement ne sont pas pris en charge et gardent les vitesses du gyroscope.
+    """
+    chapters = chapter_paths(video_path)
+    if not CAMERA_ORIENTATION or len(chapters) != 1 or not os.path.isfile(chapters[0]):
+        return None
+    try:
+        # Même repère que les positions : sans USE_ORIENTATION, le montage s'applique aux voies du gyroscope
+        return OrientationProvider.from_file(chapters[0], AXIS_REMAP, None if USE_ORIENTATION else "GYRO")
+    except ValueError as e:
+        print(f"⚠️ No camera orientation, gyroscope rates kept: {e}")
+        return None
+
+def process_gopro_video(video_path, output_path=None, streams=IMU_STREAMS, workers=1, output_format="json",
+                        sampling_rate=1.0, cache=None, save_reordered=True):
     """
-    Traitement complet d'une vidéo GoPro.
+    Traitement complet d'une vidéo GoPro, ou d'un enregistrement découpé en chapitres (liste de fichiers
+    GH01xxxx, GH02xxxx, ... traités comme une seule vidéo aux timestamps continus).
     
     Étapes:
-    1. Extraction des données GPMF de la vidéo
+    1. Extraction des données GPMF de la vidéo (flux `streams` seulement, tous si None),
+       décodée par `workers` processus en parallèle, au format `output_format` ("json" ou "col" colonnaire)
     2. Traitement des données IMU (accéléromètre et gyroscope)
     3. Conversion en mouvements robot
     4. Sauvegarde des résultats
+
+    save_reordered=False n'écrit pas le fichier intermédiaire de l'étape 2 (2-Reorder-IMU-Data), qui n'est
+    alors pas mis en cache.
+
+    Le résultat de chaque étape est conservé dans `cache` (un StageCache, celui par défaut si None) sous une
+    clé dérivée de l'empreinte de la vidéo et des paramètres de l'étape : seules les étapes dont la clé a
+    changé sont recalculées.
     """
     try:
+        chapters = chapter_paths(video_path)
+        video_name = os.path.basename(chapters[0])
         print("\n=== 🎥 Starting Video Processing ===")
-        print(f"📽️ Processing video: {os.path.basename(video_path)}")
+        print(f"📽️ Processing video: {video_name}")
+        if len(chapters) > 1:
+            print(f"🎞️ {len(chapters)} chapters: {', '.join(os.path.basename(c) for c in chapters)}")
         
         # Ensure all directories exist
         print("📁 Creating necessary directories...")
         dirs = ensure_directories()
         print("✅ Directories created successfully")
-        
-        # Step 1: Extract GPMF data to JSON
-        print("\n=== 📊 Step 1: Extracting GPMF data ===")
+
+        if cache is None:
+            cache = StageCache()
         if output_path is None:
             output_path = os.path.join(
                 dirs["1-IMU-Json-Extract"],
-                os.path.splitext(os.path.basename(video_path))[0] + ".json"
+                os.path.splitext(video_name)[0] + "." + output_format
             )
+
+        # Le cache ne concerne que les fichiers seuls, un dossier produit plusieurs fichiers d'étape 1
+        if cache.enabled and all(os.path.isfile(chapter) for chapter in chapters):
+            extract_key, reorder_key, convert_key = get_stage_keys(video_path, streams, output_format, sampling_rate)
+            extract_file = get_conv_files_list(os.path.abspath(chapters[0]), os.path.abspath(output_path), output_format)[0][1]
+            base_filename = os.path.splitext(os.path.basename(extract_file))[0] + ".json"
+            reordered_file = os.path.join(dirs["2-Reorder-IMU-Data"], f"reordered_{base_filename}")
+            movements_file = os.path.join(dirs["3-Json-adapt-niryo-movement"], f"niryo_{os.path.splitext(base_filename)[0]}.json")
+
+            # Les étapes sont vérifiées depuis la dernière : un résultat en cache rend inutiles les précédentes
+            if cache.get(convert_key, ".json", movements_file):
+                print(f"♻️ Robot movements reused from cache: {os.path.basename(movements_file)}")
+            else:
+                if save_reordered and cache.get(reorder_key, ".json", reordered_file):
+                    print(f"♻️ Reordered IMU data reused from cache: {os.path.basename(reordered_file)}")
+                    with open(reordered_file, 'r') as f:
+                        reordered_data = IMUSeries.from_dicts(json.load(f))
+                else:
+                    if cache.get(extract_key, "." + output_format, extract_file):
+                        print(f"♻️ GPMF data reused from cache: {os.path.basename(extract_file)}")
+                    else:
+                        print("\n=== 📊 Step 1: Extracting GPMF data ===")
+                        print(f"⚡ Extracting data from {video_name}...")
+                        extract_file = process_video_to_json(video_path, output_path, streams, workers, output_format)[0]
+                        cache.put(extract_key, "." + output_format, extract_file)
+                        print(f"✅ GPMF data extracted successfully to {os.path.basename(extract_file)}")
+
+                    print("\n=== 🔄 Step 2: Processing IMU data ===")
+                    imu_data = get_gyro_accel_data(extract_file)
+                    reordered_data = reorder_data(imu_data, base_filename, AXIS_REMAP, USE_ORIENTATION,
+                                                  save_reordered)
+                    if save_reordered:
+                        cache.put(reorder_key, ".json", reordered_file)
+
+                print("\n=== 🤖 Step 3: Converting to Niryo format ===")
+                movements = convert_to_robot_format(reordered_data, sampling_rate, get_orientation(video_path))
+                save_movements_to_json(movements, base_filename)
+                cache.put(convert_key, ".json", movements_file)
+
+            print("\n=== ✨ Processing Complete ===")
+            print("🎉 All steps completed successfully!")
+            return True
         
-        print(f"⚡ Extracting data from {os.path.basename(video_path)}...")
-        json_files = process_video_to_json(video_path, output_path)
+        # Step 1: Extract GPMF data to JSON
+        print("\n=== 📊 Step 1: Extracting GPMF data ===")
+        print(f"⚡ Extracting data from {video_name}...")
+        json_files = process_video_to_json(video_path, output_path, streams, workers, output_format)
         print(f"✅ GPMF data extracted successfully to {len(json_files)} files:")
         for f in json_files:
             print(f"  📄 {os.path.basename(f)}")
@@ -92,14 +187,15 @@ def process_gopro_video(video_path, output_path=None):
             print(f"\n📝 Processing IMU file: {os.path.basename(json_file)}")
             print("📊 Reading and parsing IMU data...")
             imu_data = get_gyro_accel_data(json_file)
-            base_filename = os.path.basename(json_file)
+            base_filename = os.path.splitext(os.path.basename(json_file))[0] + ".json"
             print("💾 Reordering and saving processed data...")
-            reordered_data = reorder_data(imu_data, base_filename)
+            reordered_data = reorder_data(imu_data, base_filename, AXIS_REMAP, USE_ORIENTATION, save_reordered)
             
             # Step 3: Convert to Niryo format
             print("\n=== 🤖 Step 3: Converting to Niryo format ===")
             print("🔄 Converting data to robot movements...")
-            movements = convert_to_robot_format(reordered_data)
+            orientation = get_orientation(video_path) if len(json_files) == 1 else None
+            movements = convert_to_robot_format(reordered_data, sampling_rate, orientation)
             print("💾 Saving robot movements data...")
             save_movements_to_json(movements, base_filename)
         
@@ -112,20 +208,44 @@ def process_gopro_video(video_path, output_path=None):
         print(f"  ⚠️ {str(e)}")
         return False
 
-def process_directory(input_dir):
-    """Process all GoPro videos in a directory"""
+def process_directory(input_dir, workers=1, cache=None):
+    """Process all GoPro videos in a directory, in `workers` parallel processes if workers > 1
+
+    Les chapitres d'un même enregistrement (GH01xxxx, GH02xxxx, ...) sont traités ensemble comme une seule vidéo.
+    """
     print(f"\n=== 📁 Processing Directory: {input_dir} ===")
     success_count = 0
     failed_count = 0
-    total_files = len([f for f in os.listdir(input_dir) if f.lower().endswith(('.mp4', '.mov'))])
-    current_file = 0
-    
-    for filename in os.listdir(input_dir):
-        if filename.lower().endswith(('.mp4', '.mov')):
-            current_file += 1
-            video_path = os.path.join(input_dir, filename)
+    sessions = group_chapters(sorted(f for f in os.listdir(input_dir) if f.lower().endswith(('.mp4', '.mov'))))
+    # Un enregistrement en plusieurs chapitres est passé comme la liste de ses fichiers
+    videos = [
+        [os.path.join(input_dir, f) for f in session] if len(session) > 1 else os.path.join(input_dir, session[0])
+        for session in sessions
+    ]
+    total_files = len(videos)
+
+    if cache is None:
+        cache = StageCache()
+    if workers > 1:
+        print(f"⚙️ Processing {total_files} videos with {workers} workers...")
+        # Seul le processus parent évince, une fois les processus terminés
+        worker_cache = cache.for_workers()
+        outcomes = run_in_pool(process_gopro_video,
+                               [(video, None, IMU_STREAMS, 1, "json", 1.0, worker_cache) for video in videos],
+                               workers)
+        if cache.enabled:
+            cache.evict()
+        for filename, (success, error) in zip((session[0] for session in sessions), outcomes):
+            if success:
+                success_count += 1
+            else:
+                failed_count += 1
+                print(f"❌ {filename}: {error if error else 'processing failed'}")
+    else:
+        for current_file, (session, video_path) in enumerate(zip(sessions, videos), 1):
+            filename = session[0]
             print(f"\n🎥 Processing video {current_file}/{total_files}: {filename}")
-            if process_gopro_video(video_path):
+            if process_gopro_video(video_path, cache=cache):
                 success_count += 1
             else:
                 failed_count += 1
@@ -210,8 +330,12 @@ if __name__ == "__main__":
     # Afficher l'introduction avant de commencer
     display_intro()
     
-    if len(sys.argv) > 1:
-        input_path = os.path.abspath(sys.argv[1])
+    # --no-cache désactive le cache des étapes, --refresh recalcule toutes les étapes et met à jour le cache
+    cache = StageCache(enabled="--no-cache" not in sys.argv, refresh="--refresh" in sys.argv)
+    args = [arg for arg in sys.argv[1:] if arg not in ("--no-cache", "--refresh")]
+
+    if args:
+        input_path = os.path.abspath(args[0])
     else:
         # Utiliser la nouvelle fonction pour obtenir le chemin du dossier videos
         input_path = get_videos_directory()
@@ -219,12 +343,12 @@ if __name__ == "__main__":
     if os.path.isdir(input_path):
         selected_video = select_video(input_path)
         if selected_video:
-            process_gopro_video(selected_video)
+            process_gopro_video(selected_video, cache=cache)
         else:
             print("\n👋 Programme terminé.")
     elif os.path.isfile(input_path):
-        process_gopro_video(input_path)
+        process_gopro_video(input_path, cache=cache)
     else:
         print(f"\n❌ Erreur : {input_path} n'est pas un fichier ou dossier valide")
-        print("\n💡 Utilisation : python main.py [video_file_or_directory]")
+        print("\n💡 Utilisation : python main.py [--no-cache] [--refresh] [video_file_or_directory]")
         print("   ou placez simplement vos vidéos dans le dossier 'videos'")
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 """Parses the FOURCC data in GPMF stream into fields"""
+import collections
+import functools
+import itertools
+import re
 import struct
+import sys
 import construct
 import dateutil.parser
+import numpy as np
 
 TYPES = construct.Enum(
     construct.Byte,
@@ -26,19 +32,69 @@ TYPES = construct.Enum(
     nested=0x0,
 )
 
-FOURCC = construct.Struct(
-    "key" / construct.Bytes(4),
-    "type" / construct.Byte,
-    "size" / construct.Byte,
-    "repeat" / construct.Int16ub,
-    "data" / construct.Aligned(4, construct.Bytes(construct.this.size * construct.this.repeat))
+# KLV header: FOURCC key, type, size of one sample, repeat count
+KLV_HEADER = struct.Struct('>4sBBH')
+
+# Header fields of a KLV element with the offset and length of its data in the walked buffer
+KLV = collections.namedtuple('KLV', ['key', 'type', 'size', 'repeat', 'offset', 'length'])
+
+# Leaf element yielded by recursive, data is a memoryview slice of the payload and type_def the TYPE of its stream
+Element = collections.namedtuple('Element', ['key', 'type', 'size', 'repeat', 'data', 'type_def'], defaults=(None,))
+
+# Leaf element with its value already decoded, as returned by worker processes (see GPMFElement.decoded)
+DecodedElement = collections.namedtuple('DecodedElement', ['path', 'value', 'strm'])
+
+
+# Big-endian NumPy dtypes for the fixed-size numeric GPMF types
+NUMPY_TYPES = {
+    'int8_t': np.dtype('>i1'),
+    'uint8_t': np.dtype('>u1'),
+    'int16_t': np.dtype('>i2'),
+    'uint16_t': np.dtype('>u2'),
+    'int32_t': np.dtype('>i4'),
+    'uint32_t': np.dtype('>u4'),
+    'float': np.dtype('>f4'),
+    'double': np.dtype('>f8'),
+    'int64_t': np.dtype('>i8'),
+    'uint64_t': np.dtype('>u8'),
+    'fourcc': np.dtype('S4'),
+    'Q1516': np.dtype('>i4'),
+    'Q3132': np.dtype('>i8'),
+}
+
+# struct codes of the numeric types, for single values
+STRUCT_CODES = {
+    'int8_t': 'b', 'uint8_t': 'B', 'int16_t': 'h', 'uint16_t': 'H', 'int32_t': 'i', 'uint32_t': 'I',
+    'float': 'f', 'double': 'd', 'int64_t': 'q', 'uint64_t': 'Q',
+}
+
+# Fixed point types, stored as signed integers of this many fractional units
+Q_SCALES = {
+    'Q1516': float(1 << 16),
+    'Q3132': float(1 << 32),
+}
+
+# Type byte to type name, a dict lookup instead of TYPES.parse for every element
+TYPE_NAMES = dict(TYPES.decoding)
+
+# Types decoded by parse_value without as_array besides complex, other types (char, uuid) keep raising ValueError
+VALUE_TYPES = (
+    'int8_t', 'uint8_t', 'int16_t', 'uint16_t', 'int32_t', 'uint32_t', 'int64_t', 'uint64_t',
+    'float', 'double', 'fourcc', 'Q1516', 'Q3132',
 )
 
+# One field of a TYPE string, a type character with an optional [count]
+TYPE_FIELD = re.compile(rb'([a-zA-Z?])(?:\[(\d+)\])?')
+
 
-def parse_value(element):
-    """Parses element value"""
-    type_parsed = TYPES.parse(bytes([element.type]))
-    #print("DEBUG: type_parsed={}, element.repeat={}, element.size={}, len(element.data): {}".format(type_parsed, element.repeat, element.size, len(element.data)))
+def parse_value(element, as_array=False):
+    """Parses element value, as a (repeat, size/elem) NumPy array if as_array is set
+
+    complex elements are decoded with the TYPE of their stream (element.type_def), as a structured array.
+    """
+    if not as_array:
+        return compile_decoder(element)(element)
+    type_parsed = type_name(element.type)
 
     # Special cases
     if type_parsed == 'char' and element.key == b'GPSU':
@@ -46,58 +102,148 @@ def parse_value(element):
     if type_parsed == 'utcdate':
         return parse_goprodate(element)
 
-    # Basic number types
-    struct_key = None
-    struct_repeat = element.repeat
-    if type_parsed == 'int32_t':
-        struct_key = 'l'
-        # It seems gopro is "creative" with grouped values and size vs repeat...
-        if element.size > 4:
-            struct_repeat = int(element.repeat * (element.size / 4))
-    if type_parsed == 'uint32_t':
-        struct_key = 'L'
-        if element.size > 4:
-            struct_repeat = int(element.repeat * (element.size / 4))
-
-    if type_parsed == 'int16_t':
-        struct_key = 'h'
-        if element.size > 2:
-            struct_repeat = int(element.repeat * (element.size / 2))
-    if type_parsed == 'uint16_t':
-        struct_key = 'H'
-        if element.size > 2:
-            struct_repeat = int(element.repeat * (element.size / 2))
-
-    if type_parsed == 'float':
-        struct_key = 'f'
-        if element.size > 4:
-            struct_repeat = int(element.repeat * (element.size / 4))
-
-    if not struct_key:
+    if type_parsed == 'complex':
+        return parse_records(element)
+    return parse_array(element, type_parsed)
+
+
+def compile_decoder(element):
+    """Compiles the parse_value decoder of elements laid out like element (same key, type, size and TYPE)"""
+    type_parsed = type_name(element.type)
+
+    # Special cases
+    if type_parsed == 'char' and element.key == b'GPSU':
+        return parse_goprodate
+    if type_parsed == 'utcdate':
+        return parse_goprodate
+
+    if type_parsed == 'complex':
+        if element.type_def is None:
+            raise ValueError("complex element {} without TYPE".format(element.key))
+        dtype, q_fields = type_dtype(element.type_def)
+        if q_fields or dtype.itemsize != element.size:
+            return lambda e: records_to_value(parse_records(e))
+        return lambda e: records_to_value(np.frombuffer(e.data, dtype=dtype, count=e.repeat))
+    if type_parsed not in VALUE_TYPES:
         raise ValueError("{} does not have value parser yet".format(type_parsed))
+    dtype = NUMPY_TYPES[type_parsed]
+    if dtype.kind == 'S' or type_parsed in Q_SCALES or element.size % dtype.itemsize:
+        return lambda e: array_to_value(parse_array(e, type_parsed))
+    width = element.size // dtype.itemsize
+
+    def decode(e):
+        # Most metadata elements (STMP, TSMP, SCAL...) hold a single value
+        if e.repeat == 1 and width == 1:
+            return scalar.unpack_from(e.data)[0]
+        return array_to_value(np.frombuffer(e.data, dtype=dtype, count=e.repeat * width).reshape(e.repeat, width))
+    scalar = struct.Struct('>' + STRUCT_CODES[type_parsed])
+    return decode
+
 
-    struct_format = ">{}".format(''.join([struct_key for x in range(struct_repeat)]))
-    #print("DEBUG: struct_format={}".format(struct_format))
+def type_name(type_byte):
+    """Returns the TYPES name of a type byte"""
     try:
-        value_parsed = struct.unpack(struct_format, element.data)
-    except struct.error as e:
-        #print("ERROR: {}".format(e))
-        #print("DEBUG: struct_format={}, data (len: {}) was: {}".format(struct_format, len(element.data), element.data))
-        raise ValueError("Struct unpack failed: {}".format(e))
+        return TYPE_NAMES[type_byte]
+    except KeyError:
+        raise ValueError("Unknown type {!r}".format(chr(type_byte)))
 
+
+def parse_array(element, type_parsed=None):
+    """Decodes element data straight from the payload bytes into a (repeat, size/elem) array"""
+    if type_parsed is None:
+        type_parsed = type_name(element.type)
+    dtype = NUMPY_TYPES.get(type_parsed)
+    if dtype is None:
+        raise ValueError("{} does not have array parser yet".format(type_parsed))
+    # It seems gopro is "creative" with grouped values and size vs repeat...
+    if element.size % dtype.itemsize:
+        raise ValueError("Size {} is not a multiple of {}".format(element.size, type_parsed))
+    width = element.size // dtype.itemsize
+    try:
+        values = np.frombuffer(element.data, dtype=dtype, count=element.repeat * width)
+    except ValueError as e:
+        raise ValueError("Array decode failed: {}".format(e))
+    if type_parsed in Q_SCALES:
+        return values.reshape(element.repeat, width) / Q_SCALES[type_parsed]
+    return values.reshape(element.repeat, width)
+
+
+def parse_records(element):
+    """Decodes a complex element into a (repeat,) structured array in one call, Q fields converted to float"""
+    if element.type_def is None:
+        raise ValueError("complex element {} without TYPE".format(element.key))
+    dtype, q_fields = type_dtype(element.type_def)
+    if dtype.itemsize != element.size:
+        raise ValueError("TYPE {} is {} bytes, not {}".format(element.type_def, dtype.itemsize, element.size))
+    try:
+        records = np.frombuffer(element.data, dtype=dtype, count=element.repeat)
+    except ValueError as e:
+        raise ValueError("Records decode failed: {}".format(e))
+    if not q_fields:
+        return records
+    # Same fields with the fixed point ones as float64, converted column by column
+    values = records.astype([
+        (name, np.float64 if name in q_fields else dtype.fields[name][0]) for name in dtype.names
+    ])
+    for name, scale in q_fields.items():
+        values[name] /= scale
+    return values
+
+
+@functools.lru_cache(maxsize=None)
+def type_dtype(type_def):
+    """Compiles a TYPE string into a big-endian structured dtype and its {field: Q scale}, once per TYPE"""
+    fields = []
+    q_fields = {}
+    for idx, (char, count) in enumerate(TYPE_FIELD.findall(bytes(type_def).rstrip(b'\0'))):
+        type_parsed = type_name(char[0])
+        count = int(count) if count else 1
+        name = 'f{}'.format(idx)
+        if type_parsed == 'char':
+            fields.append((name, 'S{}'.format(count)))
+            continue
+        dtype = NUMPY_TYPES.get(type_parsed)
+        if dtype is None:
+            raise ValueError("{} cannot be a TYPE field".format(type_parsed))
+        fields.append((name, dtype, (count,)) if count > 1 else (name, dtype))
+        if type_parsed in Q_SCALES:
+            q_fields[name] = Q_SCALES[type_parsed]
+    if not fields:
+        raise ValueError("Empty TYPE {}".format(type_def))
+    return np.dtype(fields), q_fields
+
+
+def array_to_value(values):
+    """Converts a parse_array result to the scalar / list / list of tuples of the tuple path"""
+    if values.dtype.kind == 'S':
+        values = np.char.decode(values, 'latin-1')
     # Single value
-    if len(value_parsed) == 1:
-        return value_parsed[0]
+    if values.size == 1:
+        return values.item()
     # Grouped values
-    if len(value_parsed) > element.repeat:
-        n = int(len(value_parsed) / element.repeat)
-        return [value_parsed[i:i + n] for i in range(0, len(value_parsed), n)]
-    return list(value_parsed)
+    if values.shape[1] > 1:
+        return list(map(tuple, values.tolist()))
+    return values.ravel().tolist()
+
+
+def records_to_value(records):
+    """Converts a parse_records result to a tuple per record (a single tuple for one record), text decoded"""
+    rows = [tuple(map(field_to_value, row)) for row in records.tolist()]
+    return rows[0] if len(rows) == 1 else rows
+
+
+def field_to_value(field):
+    """Converts one field of a record to a JSON-friendly value, [count] fields being arrays"""
+    if isinstance(field, bytes):
+        return field.rstrip(b'\0').decode('latin-1')
+    if isinstance(field, np.ndarray):
+        return field.tolist()
+    return field
 
 
 def parse_goprodate(element):
     """Parses the gopro date string from element to Python datetime"""
-    goprotime = element.data.decode('UTF-8')
+    goprotime = bytes(element.data).decode('UTF-8')
     return dateutil.parser.parse("{}-{}-{}T{}:{}:{}Z".format(
         2000 + int(goprotime[:2]),  # years
         int(goprotime[2:4]),        # months
@@ -108,16 +254,266 @@ def parse_goprodate(element):
     ))
 
 
-def recursive(data, parents=tuple()):
-    """Recursive parser returns depth-first traversing generator yielding fields and list of their parent keys"""
-    elements = FOURCC[:].parse(data)
-    for element in elements:
-        if element.type == 0:
-            subparents = parents + (element.key,)
-            for subyield in recursive(element.data, subparents):
-                yield subyield
+def walk_klv(view, start=0, end=None):
+    """Walks the KLV headers of a buffer, yielding KLV records without copying any data"""
+    if end is None:
+        end = len(view)
+    unpack_from = KLV_HEADER.unpack_from
+    pos = start
+    while pos + 8 <= end:
+        key, type_, size, repeat = unpack_from(view, pos)
+        length = size * repeat
+        if pos + 8 + length > end:
+            # Truncated element
+            return
+        yield KLV(key, type_, size, repeat, pos + 8, length)
+        # Data is 32-bit aligned
+        pos += 8 + ((length + 3) & ~3)
+
+
+def recursive(data, parents=tuple(), streams=None):
+    """Recursive parser returns depth-first traversing generator yielding fields and list of their parent keys
+
+    If streams is given, only STRM containers holding one of these FourCCs are parsed, others are skipped by length.
+    """
+    return recursive_view(memoryview(data), parents, stream_keys(streams))
+
+
+def recursive_streams(data, streams=None):
+    """Like recursive, yielding (element, parents, STRM number), STRM containers being numbered in payload order
+
+    The number is None for elements outside of any STRM (DVID, DVNM...).
+    """
+    return walk_elements(memoryview(data), tuple(), stream_keys(streams), itertools.count(), None)
+
+
+def stream_keys(streams):
+    """Normalizes a streams filter to None or a frozenset of bytes FourCCs"""
+    if streams is None:
+        return None
+    return frozenset(x.encode('latin-1') if isinstance(x, str) else x for x in streams)
+
+
+def recursive_view(view, parents, streams):
+    """Depth-first traversal of a memoryview, streams being None or a set of bytes FourCCs"""
+    for element, element_parents, _ in walk_elements(view, parents, streams, itertools.count(), None):
+        yield (element, element_parents)
+
+
+def walk_elements(view, parents, streams, strms, strm):
+    """Depth-first traversal yielding (element, parents, STRM number), strms being the STRM number counter"""
+    type_def = None
+    for klv in walk_klv(view):
+        if klv.type == 0:
+            substrm = strm
+            if klv.key == b'STRM':
+                if streams is not None and not has_stream(view, klv, streams):
+                    continue
+                substrm = next(strms)
+            subparents = parents + (klv.key,)
+            yield from walk_elements(view[klv.offset:klv.offset + klv.length], subparents, streams, strms, substrm)
         else:
-            yield (element, parents)
+            data = view[klv.offset:klv.offset + klv.length]
+            if klv.key == b'TYPE':
+                # Describes the complex samples that follow it in the same stream
+                type_def = bytes(data)
+            yield (Element(klv.key, klv.type, klv.size, klv.repeat, data, type_def), parents, strm)
+
+
+class GPMFElement:
+    """Leaf element of a decoded payload: FourCC path, STRM number and raw data, decoded on access of value
+
+    Samples stay a few bytes each instead of Python lists of numbers, and path, key and TYPE are shared by the
+    elements of every payload with the same layout. The element is its own decoder argument (see compile_decoder).
+    """
+
+    __slots__ = ('path', 'strm', 'key', 'type', 'size', 'repeat', 'data', 'type_def', 'decode')
+
+    def __init__(self, path, strm, key, type, size, repeat, data, type_def=None, decode=None):
+        self.path = path
+        self.strm = strm
+        self.key = key
+        self.type = type
+        self.size = size
+        self.repeat = repeat
+        self.data = data
+        self.type_def = type_def
+        self.decode = decode if decode is not None else layout_decoder(key, type, size, type_def)
+
+    def __repr__(self):
+        return "<GPMFElement {} x{}>".format(' > '.join(self.path), self.repeat)
+
+    def __reduce__(self):
+        # Compiled decoders are closures, the receiving process looks its own up
+        return (GPMFElement, (self.path, self.strm, self.key, self.type, self.size, self.repeat, self.data,
+                              self.type_def))
+
+    @property
+    def value(self):
+        """Decoded value as parse_value returns it, raw bytes when undecodable"""
+        try:
+            return self.decode(self)
+        except ValueError:
+            return self.data
+
+    def decoded(self):
+        """Returns the element as a DecodedElement, its value decoded now"""
+        return DecodedElement(self.path, self.value, self.strm)
+
+
+# Actions of the steps of a PayloadDecoder plan
+PLAN_DESCEND = 0   # container walked into
+PLAN_SKIP = 1      # container jumped over, a STRM without the requested streams
+PLAN_LEAF = 2      # leaf element read at its offset
+PLAN_TYPE = 3      # TYPE leaf, its data must match the planned TYPE
+PLAN_EXIT = 4      # end of the current container
+
+
+class PayloadDecoder:
+    """Decodes the payloads of one recording through a plan compiled from the first payload
+
+    The plan lists every KLV header of the payload in traversal order as (key, type, size, action, leaf), leaf
+    holding the FourCC path, STRM number, TYPE and compiled decoder of leaf elements. Later payloads are read by
+    following the plan: each header is checked against it (repeat counts may change) and leaf data is sliced at
+    the offset reached, without walking the payload again. A skipped STRM is checked for the requested streams,
+    which a device may add to it mid-recording. A payload that does not match is parsed in full and its plan
+    replaces the previous one.
+    """
+
+    def __init__(self, streams=None):
+        self.streams = streams
+        self.stream_keys = stream_keys(streams)
+        self.plan = None
+        # Number of plans compiled so far, 1 while the layout is stable
+        self.compiled = 0
+
+    def decode(self, gpmf_data):
+        """Returns [(FourCC path tuple of str, value, STRM number)] for the leaf elements of gpmf_data
+
+        Values are raw bytes when undecodable, the STRM number is None outside of streams (see recursive_streams).
+        """
+        return [(element.path, element.value, element.strm) for element in self.elements(gpmf_data)]
+
+    def elements(self, gpmf_data):
+        """Returns the GPMFElement of every leaf element of gpmf_data, holding a copy of its data"""
+        data = gpmf_data if isinstance(gpmf_data, bytes) else bytes(gpmf_data)
+        leaves = self.follow_plan(data) if self.plan is not None else None
+        if leaves is None:
+            self.plan, leaves = compile_plan(data, self.stream_keys)
+            self.compiled += 1
+        return [
+            GPMFElement(path, strm, key, type_, size, repeat, data[offset:offset + length], type_def, decode)
+            for (key, type_, size, (path, strm, type_def, decode)), repeat, offset, length in leaves
+        ]
+
+    def follow_plan(self, data):
+        """Reads the leaves of data at the offsets reached by the plan, None if data does not match it
+
+        Returns [((key, type, size, leaf), repeat, data offset, data length)].
+        """
+        unpack_from = KLV_HEADER.unpack_from
+        pos = 0
+        end = len(data)
+        # (end of the parent container, position after the current one)
+        stack = []
+        leaves = []
+        for key, type_, size, action, leaf in self.plan:
+            if action == PLAN_EXIT:
+                # The walk of a container stops when no header fits before its end
+                if pos + 8 <= end:
+                    return None
+                end, pos = stack.pop()
+                continue
+            if pos + 8 > end:
+                return None
+            found_key, found_type, found_size, repeat = unpack_from(data, pos)
+            if found_key != key or found_type != type_ or found_size != size:
+                return None
+            offset = pos + 8
+            length = size * repeat
+            if offset + length > end:
+                return None
+            # Data is 32-bit aligned
+            next_pos = offset + ((length + 3) & ~3)
+            if action == PLAN_DESCEND:
+                stack.append((end, next_pos))
+                pos = offset
+                end = offset + length
+                continue
+            pos = next_pos
+            if action == PLAN_SKIP:
+                # Skipped while it held none of the requested streams, it must still hold none
+                if has_stream(memoryview(data), KLV(key, type_, size, repeat, offset, length), self.stream_keys):
+                    return None
+                continue
+            if action == PLAN_TYPE and data[offset:offset + length] != leaf[2]:
+                return None
+            leaves.append(((key, type_, size, leaf), repeat, offset, length))
+        if pos + 8 <= end:
+            return None
+        return leaves
+
+
+def compile_plan(data, streams):
+    """Walks a payload like recursive_streams, returns (plan, leaves) as used by PayloadDecoder.follow_plan
+
+    streams is None or a set of bytes FourCCs. The leaves are those of data, the plan is for the next payloads.
+    """
+    view = memoryview(data)
+    plan = []
+    leaves = []
+    strms = itertools.count()
+
+    def walk(start, end, parents, strm):
+        type_def = None
+        for klv in walk_klv(view, start, end):
+            if klv.type == 0:
+                if klv.key == b'STRM' and streams is not None and not has_stream(view, klv, streams):
+                    plan.append((klv.key, klv.type, klv.size, PLAN_SKIP, None))
+                    continue
+                plan.append((klv.key, klv.type, klv.size, PLAN_DESCEND, None))
+                substrm = next(strms) if klv.key == b'STRM' else strm
+                walk(klv.offset, klv.offset + klv.length, parents + (klv.key,), substrm)
+                plan.append((None, None, None, PLAN_EXIT, None))
+                continue
+            if klv.key == b'TYPE':
+                # Describes the complex samples that follow it in the same stream
+                type_def = bytes(view[klv.offset:klv.offset + klv.length])
+            leaf = (fourcc_path(parents + (klv.key,)), strm, type_def,
+                    layout_decoder(klv.key, klv.type, klv.size, type_def))
+            plan.append((klv.key, klv.type, klv.size, PLAN_TYPE if klv.key == b'TYPE' else PLAN_LEAF, leaf))
+            leaves.append(((klv.key, klv.type, klv.size, leaf), klv.repeat, klv.offset, klv.length))
+
+    walk(0, len(view), tuple(), None)
+    return plan, leaves
+
+
+@functools.lru_cache(maxsize=None)
+def fourcc_path(keys):
+    """Returns the path of a tuple of bytes FourCCs as a tuple of interned str, the same tuple for equal keys"""
+    return tuple(sys.intern(key.decode('latin-1')) for key in keys)
+
+
+@functools.lru_cache(maxsize=None)
+def layout_decoder(key, type_, size, type_def):
+    """Returns the compiled decoder of elements with this layout, element_bytes for undecodable ones"""
+    try:
+        return compile_decoder(Element(key, type_, size, 1, b'', type_def))
+    except ValueError:
+        return element_bytes
+
+
+def element_bytes(element):
+    """Returns the raw data of an element"""
+    return bytes(element.data)
+
+
+def has_stream(view, strm, streams):
+    """Checks the child headers of a STRM container for one of the streams FourCCs"""
+    for klv in walk_klv(view, strm.offset, strm.offset + strm.length):
+        if klv.key in streams:
+            return True
+    return False
 
 
 if __name__ == '__main__':
@@ -129,7 +525,7 @@ if __name__ == '__main__':
             try:
                 value = parse_value(element)
             except ValueError:
-                value = element.data
+                value = bytes(element.data)
             print("{} {} > {}: {}".format(
                 timestamps,
                 ' > '.join([x.decode('ascii') for x in parents]),
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""Random access to GPMF telemetry streams by time range"""
+from gpmf_file import GPMFFile
+
+
+def read_stream(filepath, fourcc, t0_ms, t1_ms):
+    """Reads the fourcc samples within [t0_ms, t1_ms), returns (timestamps in ms, scaled samples[N, k])
+
+    Payloads are located with the sidecar index, only the samples of those overlapping the range are read.
+    """
+    with GPMFFile(filepath) as gpmf:
+        if fourcc not in gpmf:
+            raise KeyError("No {} stream in {}".format(fourcc, filepath))
+        return gpmf[fourcc].read(t0_ms, t1_ms)
+
+
+def list_streams(filepath):
+    """Lists the streams of filepath as {fourcc: (name, units, sample count, mean rate in Hz)}"""
+    with GPMFFile(filepath) as gpmf:
+        return {
+            fourcc: (stream.name, stream.units, stream.count, stream.rate)
+            for fourcc, stream in gpmf.streams.items()
+        }
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) == 2:
+        for fourcc, (name, units, count, rate) in list_streams(sys.argv[1]).items():
+            print("{} {} ({}): {} samples, {:.1f} Hz".format(fourcc, name, units, count, rate))
+        sys.exit()
+    timestamps, samples = read_stream(sys.argv[1], sys.argv[2], float(sys.argv[3]), float(sys.argv[4]))
+    print("{} samples of {} from {} ms to {} ms".format(len(samples), sys.argv[2], sys.argv[3], sys.argv[4]))
+    for timestamp, sample in zip(timestamps, samples):
+        print("{:.3f} {}".format(timestamp, sample))
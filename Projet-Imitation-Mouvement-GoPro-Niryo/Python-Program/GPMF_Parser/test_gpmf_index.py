@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""Checks of the sidecar index, run with "python -m pytest" from this directory"""
+import numpy as np
+import pytest
+from extract import SAMPLE_TABLE_DTYPE
+from gpmf_index import GPMFIndex, StreamIndex, load_index
+
+
+def write_index(path):
+    """Saves a two-payload index with one ACCL stream to path, returns its bytes"""
+    payloads = np.zeros(2, dtype=SAMPLE_TABLE_DTYPE)
+    per_payload = lambda value: np.full(2, value, dtype=np.int64)
+    accl = StreamIndex("ACCL", "s", 6, "Accelerometer", "m/s2", -1, "", np.array([417]), per_payload(64),
+                       per_payload(200), per_payload(-1), per_payload(-1), "ZXY", "")
+    GPMFIndex("video.mp4", 1000, 0, None, 1000, payloads, {"ACCL": accl}).save(str(path))
+    return path.read_bytes()
+
+
+def test_load_index(tmp_path):
+    path = tmp_path / "video.mp4.gpmfidx"
+    write_index(path)
+    index = load_index(str(path), "video.mp4")
+    assert index.streams["ACCL"].input_orientation == "ZXY"
+    assert index.streams["ACCL"].count.tolist() == [200, 200]
+
+
+@pytest.mark.parametrize("length", [0, 100, -100])
+def test_load_truncated_index(tmp_path, length):
+    # A truncated sidecar is unreadable, open_index then rebuilds it
+    path = tmp_path / "video.mp4.gpmfidx"
+    data = write_index(path)
+    path.write_bytes(data[:length])
+    assert load_index(str(path), "video.mp4") is None
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""Checks of the payload decoder, run with "python -m pytest" from this directory"""
+import struct
+import tracemalloc
+from parse import PayloadDecoder
+
+# Memory the GPMFElement records of decoded payloads may hold, as a multiple of the payload bytes
+MAX_RECORDS_PER_PAYLOAD_BYTE = 4
+
+
+def klv(key, type_char, size, repeat, data):
+    """Returns a KLV element, its data padded to 32 bits"""
+    return key + struct.pack('>cBH', type_char, size, repeat) + data + b'\0' * (-len(data) % 4)
+
+
+def build_payload(*fourccs, samples=2):
+    """Returns a DEVC payload with one STRM of int16 triplets per FourCC"""
+    streams = b''
+    for key in fourccs:
+        strm = klv(b'SCAL', b's', 2, 1, struct.pack('>h', 100)) + klv(key, b's', 6, samples, bytes(6 * samples))
+        streams += klv(b'STRM', b'\0', 4, len(strm) // 4, strm)
+    return klv(b'DEVC', b'\0', 4, len(streams) // 4, streams)
+
+
+def test_plan_followed():
+    decoder = PayloadDecoder({"ACCL"})
+    decoder.elements(build_payload(b'GYRO', b'ACCL'))
+    elements = decoder.elements(build_payload(b'GYRO', b'ACCL', samples=5))
+    assert decoder.compiled == 1
+    assert [(e.path[-1], e.repeat) for e in elements] == [("SCAL", 1), ("ACCL", 5)]
+
+
+def test_skipped_stream_gains_requested_fourcc():
+    # The STRM skipped by the plan holds ACCL in the next payload, its samples must not be dropped
+    decoder = PayloadDecoder({"ACCL"})
+    assert decoder.elements(build_payload(b'GYRO')) == []
+    elements = decoder.elements(build_payload(b'ACCL'))
+    assert decoder.compiled == 2
+    assert [e.path for e in elements] == [("DEVC", "STRM", "SCAL"), ("DEVC", "STRM", "ACCL")]
+
+
+def test_elements_memory():
+    payloads = [build_payload(b'ACCL', b'GYRO', samples=200) for _ in range(50)]
+    decoder = PayloadDecoder()
+    tracemalloc.start()
+    try:
+        elements = [decoder.elements(gpmf_data) for gpmf_data in payloads]
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert len(elements) == len(payloads)
+    assert retained <= MAX_RECORDS_PER_PAYLOAD_BYTE * sum(len(gpmf_data) for gpmf_data in payloads)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Per-sample timestamps of GPMF streams from a linear model of the sensor clock
+
+Each payload of a stream carries STMP, the time in µs of its first sample, and TSMP, the total number of samples
+delivered so far including its own. Sample k of the stream is at offset + k * period, offset and period being
+fitted by least squares over all the payloads at once, so sample counts varying from payload to payload are
+timed exactly. STMP or TSMP going backwards (clock reset, joined recordings) starts a new segment with its own fit,
+placed right after the previous segment like chapters.iter_chapter_locations places chapters.
+"""
+import numpy as np
+
+
+class ClockModel:
+    """Fitted sensor clock of a stream, one (offset, period) line per segment of payloads"""
+
+    def __init__(self, offset_us, period_us, payload_segment, first_index, residual_us):
+        # Time in µs of sample index 0 and time between samples, per segment
+        self.offset_us = offset_us
+        self.period_us = period_us
+        # Segment of every payload and stream index of its first sample
+        self.payload_segment = payload_segment
+        self.first_index = first_index
+        # RMS distance of the STMP values to the fitted lines
+        self.residual_us = residual_us
+
+    def __repr__(self):
+        return "<ClockModel {:.3f} Hz, {} segment(s), residual {:.1f} µs>".format(
+            self.rate, len(self.period_us), self.residual_us)
+
+    @property
+    def rate(self):
+        """Sample rate in Hz of the longest running segment"""
+        longest = np.argmax(np.bincount(self.payload_segment, minlength=len(self.period_us)))
+        return 1e6 / self.period_us[longest]
+
+    def sample_times_us(self, count):
+        """Returns the time in µs of every sample of payloads holding count samples each"""
+        count = np.asarray(count, dtype=np.int64)
+        starts = np.cumsum(count) - count
+        # Index of every sample within its payload
+        positions = np.arange(count.sum()) - np.repeat(starts, count)
+        segment = np.repeat(self.payload_segment, count)
+        indices = np.repeat(self.first_index, count) + positions
+        return self.offset_us[segment] + self.period_us[segment] * indices
+
+
+def first_sample_indices(count, tsmp):
+    """Returns the stream index of the first sample of each payload, from TSMP when every payload has one"""
+    count = np.asarray(count, dtype=np.int64)
+    tsmp = np.asarray(tsmp, dtype=np.int64)
+    if len(tsmp) and (tsmp >= 0).all():
+        return tsmp - count
+    return np.cumsum(count) - count
+
+
+def fit_clock(stmp, tsmp, count):
+    """Fits the ClockModel of a stream from its per-payload STMP (µs, -1 if absent), TSMP (-1 if absent) and counts
+
+    Raises ValueError when no segment has two payloads with STMP to fit a period on.
+    """
+    stmp = np.asarray(stmp, dtype=np.int64)
+    count = np.asarray(count, dtype=np.int64)
+    first_index = first_sample_indices(count, tsmp)
+    valid = (stmp >= 0) & (count > 0)
+
+    # A new segment starts wherever STMP or the sample index goes backwards between timed payloads
+    timed = np.flatnonzero(valid)
+    breaks = np.zeros(len(stmp), dtype=np.int64)
+    backwards = (np.diff(stmp[timed]) < 0) | (np.diff(first_index[timed]) < 0)
+    breaks[timed[1:][backwards]] = 1
+    payload_segment = np.cumsum(breaks)
+    segments = payload_segment[-1] + 1 if len(stmp) else 0
+
+    # Closed form least squares of every segment at once, on centered values for precision
+    seg = payload_segment[valid]
+    x = first_index[valid].astype(np.float64)
+    y = stmp[valid].astype(np.float64)
+    n = np.bincount(seg, minlength=segments).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.bincount(seg, weights=x, minlength=segments) / n
+        y_mean = np.bincount(seg, weights=y, minlength=segments) / n
+        dx = x - x_mean[seg]
+        dy = y - y_mean[seg]
+        sxx = np.bincount(seg, weights=dx * dx, minlength=segments)
+        sxy = np.bincount(seg, weights=dx * dy, minlength=segments)
+        period = sxy / sxx
+    fitted = np.isfinite(period) & (period > 0)
+    if not fitted.any():
+        raise ValueError("No two payloads with STMP and samples to fit a clock on")
+    # Segments of a single timed payload get the period of the others
+    period = np.where(fitted, period, np.median(period[fitted]))
+    x_mean = np.where(np.isfinite(x_mean), x_mean, 0.0)
+    y_mean = np.where(np.isfinite(y_mean), y_mean, 0.0)
+    offset = y_mean - period * x_mean
+
+    # A segment starting before the end of the previous one (reset clock) continues right after it instead
+    boundaries = np.flatnonzero(np.diff(payload_segment)) + 1
+    ends = first_index + count
+    for segment, payload in enumerate(boundaries.tolist(), 1):
+        previous_end = offset[segment - 1] + period[segment - 1] * ends[payload - 1]
+        start = offset[segment] + period[segment] * first_index[payload]
+        if start < previous_end:
+            offset[segment] += previous_end - start
+
+    residuals = y - (y_mean[seg] + period[seg] * dx)
+    residual = float(np.sqrt(np.mean(residuals ** 2))) if len(residuals) else 0.0
+    return ClockModel(offset, period, payload_segment, first_index, residual)
+
+
+def stream_times_ms(stmp, tsmp, count):
+    """Returns the time in ms on the sensor clock of every sample of a stream, see fit_clock"""
+    return fit_clock(stmp, tsmp, count).sample_times_us(count) / 1000.0
+
+
+if __name__ == '__main__':
+    import sys
+    from gpmf_index import open_index
+    index = open_index(sys.argv[1])
+    for fourcc, stream in index.streams.items():
+        try:
+            print("{} {}".format(fourcc, fit_clock(stream.stmp, stream.tsmp, stream.count)))
+        except ValueError as e:
+            print("{} {}".format(fourcc, e))